@@ -67,6 +67,31 @@ def build_databunch(query, num_splits=3, max_size=None):
     return databunch
 
 
+def batch_fingerprint(package):
+    """SHA-256 of the package's table_name and records.  Sent as 'fingerprint' so the API
+    acknowledges a resent package without writing it again.
+    """
+    import hashlib
+    import json
+    canonical = json.dumps({'table_name': package['table_name'], 'data': package['data']},
+                           sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def encode_body(package, compress=True):
+    """JSON body and headers for a POST.  gzip compressed unless compress is False.
+    Review text and token columns typically shrink 4-5x.
+    """
+    import gzip
+    import json
+    body = json.dumps(package).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if compress:
+        body = gzip.compress(body, compresslevel=3)
+        headers['Content-Encoding'] = 'gzip'
+    return body, headers
+
+
 def parallel_post_requests(databunch, url, max_requests=10):
     """Request handler that will parallelize databunch POST requests.
 
@@ -84,22 +109,41 @@ def parallel_post_requests(databunch, url, max_requests=10):
     p.join()
 
 
-def run_request(bunch, url, retry_size=20):
+def run_request(bunch, url, retry_size=20, resend=1, compress=True):
     """Run and time a request with the python requests library
+    A failed bunch is first resent as is (resend times), then split into smaller bunches.
     """
     import requests
     import time
     import numpy as np
+    if not bunch.get('fingerprint'):
+        bunch = dict(bunch, fingerprint=batch_fingerprint(bunch))
     try:
         time.sleep(np.random.random_sample()*10)
         start = time.time()
-        response = requests.post(url=url, json=bunch, timeout=None)
+        body, headers = encode_body(bunch, compress=compress)
+        response = requests.post(url=url, data=body, headers=headers, timeout=None)
+        if response.status_code == 400 and 'rejected' in response.json():
+            # Every record failed validation.  Smaller bunches would fail the same way.
+            request_logger.error("POST rejected: {}".format(response.json()['errors']))
+            return False
         assert response.status_code == 200
         request_logger.info("POST succeded.  Status= {}".format(response.status_code))
+        if response.json().get('duplicate'):
+            request_logger.info("Bunch {} was already applied.".format(bunch['fingerprint']))
+        if response.json().get('rejected'):
+            # Valid records were written.  Invalid ones are listed by index and not retried.
+            request_logger.error("{} records rejected: {}".format(
+                response.json()['rejected'], response.json()['errors']))
         stop = time.time()
         request_logger.info('Batch of {} processed in {}'.format(len(bunch['data']), stop-start))
         return True
     except:
+        if resend > 0:
+            # A timed out bunch may have been committed.  Resent with the same fingerprint,
+            # the API acknowledges it without writing it again.
+            request_logger.error("POST failed.  Resending bunch {}.".format(bunch['fingerprint']))
+            return run_request(bunch=bunch, url=url, retry_size=retry_size, resend=resend - 1, compress=compress)
         min_size = retry_size - 1
         request_logger.error("POST failed.  Trying again with smaller bunch of {}.".format(min_size))
         if min_size < 1:
@@ -107,7 +151,7 @@ def run_request(bunch, url, retry_size=20):
             return False
         databunch = build_databunch(query=bunch, max_size=min_size)
         for mini_bunch in databunch:
-            run_request(bunch=mini_bunch, url=url, retry_size=min_size)
+            run_request(bunch=mini_bunch, url=url, retry_size=min_size, compress=compress)
 
 # Deprecated. Table name now in job file under key tablename
 # def get_source_from_name(filename):
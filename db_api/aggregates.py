@@ -0,0 +1,321 @@
+"""
+Aggregates
+    Per-business review aggregates (reviews per year, star histogram, average stars) and
+    token postings (token counts per business per month) kept current by the review upsert.
+    Each batch prefetches the stored business_id/date/stars/token of the reviews it touches,
+    turns old and new values into count deltas and applies them in the batch's own
+    transaction, so biz_stats and top_tokens read a few indexed rows per business instead of
+    waiting for the viz2 notebooks or re-parsing every review.
+
+    flask rebuild-aggregates recomputes everything from the reviews table (first deploy, or
+    after reviews were written around the API).
+
+    Deltas are computed from the stored rows as the batch starts.  Review batches are
+    serialized by one writer thread per process.  On PostgreSQL, writers in other processes
+    are serialized per review: stored reviews are read with SELECT ... FOR UPDATE and new
+    review_ids take a transaction advisory lock before they are read again, so a second
+    writer sees the first one's commit and counts from it.  SQLite allows one writer at a
+    time.
+"""
+import csv
+import logging
+import re
+from collections import defaultdict
+from functools import lru_cache
+
+from sqlalchemy import Integer, and_, bindparam, cast, extract, func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import Review, BusinessReviewStats, BusinessReviewYear, BusinessStarCount, TokenPosting
+from upsert import chunks, merge_by_key
+
+
+aggregate_logger = logging.getLogger(__name__)
+
+AGGREGATE_MODELS = (BusinessReviewStats, BusinessReviewYear, BusinessStarCount, TokenPosting)
+REVIEW_FIELDS = ('business_id', 'date', 'stars', 'token')
+QUOTED = re.compile(r"'((?:[^'\\]|\\.)*)'|\"((?:[^\"\\]|\\.)*)\"")
+
+
+def star_bucket(stars):
+    # Half stars round up, like SQL ROUND() in rebuild()
+    return int(stars + 0.5)
+
+
+def period_of(date):
+    return date.strftime('%Y-%m')
+
+
+def parse_tokens(value):
+    """Tokens from a stored Review.token: array literal '{a,b}' (bulk loads and posted lists,
+    see validators.to_string) or Python list repr "['a', 'b']" (lists posted as strings).
+    Lower-cased, quotes stripped.
+    """
+    if not value:
+        return []
+    value = value.strip()
+    if value.startswith('['):
+        # Quoted items of a list of strings, without a full literal_eval per review
+        tokens = [single or double for single, double in QUOTED.findall(value)]
+        if not tokens and value[1:-1].strip():
+            tokens = value[1:-1].split(',')
+    elif value.startswith('{'):
+        tokens = next(csv.reader([value[1:-1]], escapechar='\\'), [])  # Quoted items escape \ and "
+    else:
+        tokens = value.split()
+    tokens = (str(token).strip().strip('\'"').lower() for token in tokens)
+    return [token for token in tokens if token]
+
+
+class Deltas():
+    """Count changes per aggregate row produced by one batch of reviews."""
+    def __init__(self):
+        self.stats = defaultdict(lambda: [0, 0, 0.0])  # business_id -> [reviews, rated, stars_sum]
+        self.years = defaultdict(int)  # (business_id, year) -> reviews
+        self.stars = defaultdict(int)  # (business_id, star bucket) -> reviews
+        self.tokens = defaultdict(int)  # (business_id, period, token) -> occurrences
+
+    def add(self, state, sign):
+        business_id, date, stars, token = state
+        if business_id is None:
+            return
+        stats = self.stats[business_id]
+        stats[0] += sign
+        if stars is not None:
+            stats[1] += sign
+            stats[2] += sign * stars
+            self.stars[(business_id, star_bucket(stars))] += sign
+        if date is not None:
+            self.years[(business_id, date.year)] += sign
+            period = period_of(date)
+            for word in parse_tokens(token):
+                self.tokens[(business_id, period, word)] += sign
+
+    def rows(self):
+        """{model: [row dicts]} without the rows whose counts did not change."""
+        return {
+            BusinessReviewStats: [
+                {'business_id': b, 'review_count': n, 'rated_count': r, 'stars_sum': s}
+                for b, (n, r, s) in self.stats.items() if n or r or s],
+            BusinessReviewYear: [
+                {'business_id': b, 'year': y, 'review_count': n} for (b, y), n in self.years.items() if n],
+            BusinessStarCount: [
+                {'business_id': b, 'stars': s, 'review_count': n} for (b, s), n in self.stars.items() if n],
+            TokenPosting: [
+                {'business_id': b, 'period': p, 'token': t, 'token_count': n}
+                for (b, p, t), n in self.tokens.items() if n],
+        }
+
+    def business_ids(self):
+        return set(self.stats)
+
+
+def fetch_review_states(session, review_ids):
+    """{review_id: (business_id, date, stars, token)} for reviews already stored.
+    On PostgreSQL the reviews stay locked until the batch commits, stored or not.
+    """
+    if session.bind.dialect.name != 'postgresql':
+        return select_review_states(session, review_ids)
+    review_ids = sorted(review_ids)  # Same lock order in every writer
+    states = select_review_states(session, review_ids, lock=True)
+    new = [review_id for review_id in review_ids if review_id not in states]
+    if new:
+        # No row to lock yet: hold the review_id until commit, then read again in case
+        # another writer inserted it while we waited
+        session.execute(ADVISORY_LOCKS, {'review_ids': new})
+        states.update(select_review_states(session, new, lock=True))
+    return states
+
+
+# Locks taken in hash order; a hashtext collision only serializes two unrelated reviews
+ADVISORY_LOCKS = text(
+    'SELECT pg_advisory_xact_lock(key) FROM '
+    '(SELECT hashtext(review_id) AS key FROM unnest(CAST(:review_ids AS text[])) AS review_id '
+    'ORDER BY key) AS review_keys')
+
+
+def select_review_states(session, review_ids, lock=False):
+    states = {}
+    for chunk in chunks(review_ids):
+        rows = session.query(Review.review_id, Review.business_id, Review.date, Review.stars, Review.token).\
+            filter(Review.review_id.in_(chunk))
+        if lock:
+            rows = rows.order_by(Review.review_id).with_for_update()
+        for review_id, *state in rows:
+            states[review_id] = tuple(state)
+    return states
+
+
+def update_for_reviews(session, records):
+    """Apply the aggregate changes of a review batch.  Call before the reviews are upserted,
+    inside the same session.  Returns the business_ids whose aggregates changed.
+    """
+    merged = merge_by_key(records, 'review_id')
+    stored = fetch_review_states(session, merged.keys())
+    deltas = Deltas()
+    for review_id, record in merged.items():
+        before = stored.get(review_id)
+        if before is not None:
+            deltas.add(before, -1)
+        # Fields missing from the record keep their stored value
+        after = tuple(record[field] if field in record else (before[i] if before else None)
+                      for i, field in enumerate(REVIEW_FIELDS))
+        deltas.add(after, 1)
+    for model, rows in deltas.rows().items():
+        if rows:
+            apply_deltas(session, model, rows)
+    return deltas.business_ids()
+
+
+def apply_deltas(session, model, rows):
+    """Add row counts to the stored aggregate rows, creating the missing ones."""
+    table = model.__table__
+    keys = [column.name for column in table.primary_key.columns]
+    values = [column.name for column in table.columns if column.name not in keys]
+
+    dialect = session.bind.dialect
+    if dialect.name == 'postgresql':
+        stmt = pg_insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=keys, set_={name: table.c[name] + stmt.excluded[name] for name in values})
+        session.execute(stmt, rows)
+        return
+    if dialect.name == 'sqlite' and dialect.server_version_info >= (3, 24):
+        # SQLite has the same upsert syntax.  One executemany, no prefetch.
+        session.execute(sqlite_upsert(table.name, tuple(keys), tuple(values)), rows)
+        return
+
+    # Other databases (and SQLite before 3.24): find the stored rows, then update or insert
+    existing = set()
+    for chunk in chunks({row['business_id'] for row in rows}):
+        existing.update(tuple(row) for row in session.execute(
+            select([table.c[name] for name in keys]).where(table.c.business_id.in_(chunk))))
+    updates = [row for row in rows if tuple(row[name] for name in keys) in existing]
+    inserts = [row for row in rows if tuple(row[name] for name in keys) not in existing]
+    if updates:
+        stmt = table.update().\
+            where(and_(*[table.c[name] == bindparam('key_' + name) for name in keys])).\
+            values({name: table.c[name] + bindparam('delta_' + name) for name in values})
+        session.execute(stmt, [
+            dict({'key_' + name: row[name] for name in keys}, **{'delta_' + name: row[name] for name in values})
+            for row in updates])
+    if inserts:
+        session.execute(table.insert(), inserts)
+    aggregate_logger.debug('{}: {} updated, {} inserted'.format(table.name, len(updates), len(inserts)))
+
+
+@lru_cache(maxsize=None)
+def sqlite_upsert(table_name, keys, values):
+    columns = keys + values
+    return text('INSERT INTO {table} ({columns}) VALUES ({binds}) ON CONFLICT ({keys}) DO UPDATE SET {sets}'.format(
+        table=table_name,
+        columns=', '.join(columns),
+        binds=', '.join(':' + name for name in columns),
+        keys=', '.join(keys),
+        sets=', '.join('{0} = {1}.{0} + excluded.{0}'.format(name, table_name) for name in values)))
+
+
+###Reads###
+def read_stats(session, business_ids):
+    """{business_id: package or None} from the aggregate tables"""
+    packages = {business_id: None for business_id in business_ids}
+    for chunk in chunks(business_ids):
+        for row in session.query(BusinessReviewStats).filter(BusinessReviewStats.business_id.in_(chunk)):
+            if row.review_count > 0:
+                packages[row.business_id] = {
+                    'business_id': row.business_id,
+                    'review_count': row.review_count,
+                    'average_stars': row.stars_sum / row.rated_count if row.rated_count else None,
+                    'review_by_year': {},
+                    'count_by_star': {},
+                }
+        for field, model, column in [('review_by_year', BusinessReviewYear, BusinessReviewYear.year),
+                                     ('count_by_star', BusinessStarCount, BusinessStarCount.stars)]:
+            rows = session.query(model.business_id, column, model.review_count).\
+                filter(model.business_id.in_(chunk), model.review_count > 0).order_by(column)
+            for business_id, key, count in rows:
+                if packages[business_id] is not None:
+                    packages[business_id][field][str(key)] = count
+    return packages
+
+
+def review_counts(session, business_ids):
+    """{business_id: stored reviews}.  Businesses without an aggregate row (none yet, or
+    aggregates never rebuilt) are counted from the reviews table.
+    """
+    counts = {}
+    for chunk in chunks(business_ids):
+        counts.update(session.query(BusinessReviewStats.business_id, BusinessReviewStats.review_count).
+                      filter(BusinessReviewStats.business_id.in_(chunk)))
+    missing = [business_id for business_id in business_ids if business_id not in counts]
+    for chunk in chunks(missing):
+        counts.update(session.query(Review.business_id, func.count()).
+                      filter(Review.business_id.in_(chunk)).group_by(Review.business_id))
+    return {business_id: counts.get(business_id, 0) for business_id in business_ids}
+
+
+def read_top_tokens(session, business_id, start=None, end=None, k=25):
+    """[(token, count)] most frequent first, for periods start..end (YYYY-MM, inclusive)."""
+    total = func.sum(TokenPosting.token_count).label('total')
+    query = session.query(TokenPosting.token, total).filter(TokenPosting.business_id == business_id)
+    if start:
+        query = query.filter(TokenPosting.period >= start)
+    if end:
+        query = query.filter(TokenPosting.period <= end)
+    return query.group_by(TokenPosting.token).having(total > 0).\
+        order_by(total.desc(), TokenPosting.token).limit(k).all()
+
+
+###Rebuild###
+def rebuild(engine):
+    """Recompute every aggregate from the reviews table.  Returns {table: rows}."""
+    known = Review.business_id.isnot(None)
+    year = cast(extract('year', Review.date), Integer)
+    stars = cast(func.round(Review.stars), Integer)
+    queries = {
+        BusinessReviewStats: select([Review.business_id, func.count(), func.count(Review.stars),
+                                     func.coalesce(func.sum(Review.stars), 0.0)]).
+            where(known).group_by(Review.business_id),
+        BusinessReviewYear: select([Review.business_id, year, func.count()]).
+            where(and_(known, Review.date.isnot(None))).group_by(Review.business_id, year),
+        BusinessStarCount: select([Review.business_id, stars, func.count()]).
+            where(and_(known, Review.stars.isnot(None))).group_by(Review.business_id, stars),
+    }
+    counts = {}
+    with engine.begin() as connection:
+        for model, query in queries.items():
+            table = model.__table__
+            connection.execute(table.delete())
+            connection.execute(table.insert().from_select([column.name for column in table.columns], query))
+            counts[table.name] = connection.execute(select([func.count()]).select_from(table)).scalar()
+            aggregate_logger.info('Rebuilt {}: {} rows'.format(table.name, counts[table.name]))
+        counts[TokenPosting.__tablename__] = rebuild_postings(connection)
+    return counts
+
+
+def rebuild_postings(connection):
+    """Token postings need Python to parse Review.token.  Reviews are read in business_id
+    order and each business's postings are written once it is complete.
+    """
+    table = TokenPosting.__table__
+    connection.execute(table.delete())
+    rows = connection.execution_options(stream_results=True).execute(
+        select([Review.business_id, Review.date, Review.token]).
+        where(and_(Review.business_id.isnot(None), Review.date.isnot(None), Review.token.isnot(None))).
+        order_by(Review.business_id))
+    written = 0
+    current, deltas = None, Deltas()
+    for business_id, date, token in rows:
+        if business_id != current and deltas.tokens:
+            postings = deltas.rows()[TokenPosting]
+            connection.execute(table.insert(), postings)
+            written += len(postings)
+            deltas = Deltas()
+        current = business_id
+        deltas.add((business_id, date, None, token), 1)
+    if deltas.tokens:
+        postings = deltas.rows()[TokenPosting]
+        connection.execute(table.insert(), postings)
+        written += len(postings)
+    aggregate_logger.info('Rebuilt {}: {} rows'.format(table.name, written))
+    return written
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, Response
 from flask import current_app, g
 from flask_cors import CORS
 from flask_caching import Cache
@@ -10,6 +10,9 @@ import sys
 # Custom errors
 from errors import InvalidUsage
 
+# Response encoding
+from serializer import json_response
+
 # Logging
 import logging
 
@@ -39,21 +42,84 @@ def create_app(test_config=None):
         DEBUG=config('DEBUG', default=False),  # Make sure to change debug to False in production env
         SECRET_KEY=config('SECRET_KEY', default='dev'),  # CHANGE THIS!!!!
         DATABASE_URI=config('DATABASE_URI', 'sqlite:///' + os.path.join(os.getcwd(), local_db_name)),  # For in-memory db: default='sqlite:///:memory:'),
+        DATABASE_READ_URI=config('DATABASE_READ_URI', default=''),  # Read replica for GET schemas.  Empty: use DATABASE_URI
+        DB_SLOW_QUERY_MS=config('DB_SLOW_QUERY_MS', default=500, cast=int),  # Statements slower than this are logged as warnings
         LOGFILE=config('LOGFILE', os.path.join(app.instance_path, 'logs/debug.log')),
         CACHE_TYPE=config('CACHE_TYPE', 'simple'),  # Configure caching
         CACHE_DEFAULT_TIMEOUT=config('CACHE_DEFAULT_TIMEOUT', 300), # Long cache times probably ok for ML api
+        CACHE_SCHEMA_TIMEOUTS={  # Seconds GET schema responses are cached.  0 disables.
+            'biz_words': config('CACHE_TIMEOUT_BIZ_WORDS', default=300, cast=int),
+            'biz_comp': config('CACHE_TIMEOUT_BIZ_COMP', default=900, cast=int),
+            'biz_stats': config('CACHE_TIMEOUT_BIZ_STATS', default=300, cast=int),
+            'top_tokens': config('CACHE_TIMEOUT_TOP_TOKENS', default=300, cast=int),
+            },
+        QUERY_MAX_ROWS={  # Rows a JSON GET may return before it is refused with 413.  0 disables.
+            'biz_words': config('MAX_ROWS_BIZ_WORDS', default=50000, cast=int),
+            'biz_comp': config('MAX_ROWS_BIZ_COMP', default=500, cast=int),
+            'biz_stats': config('MAX_ROWS_BIZ_STATS', default=1000, cast=int),
+            },
+        QUERY_TIMEOUT_MS={  # Statement timeout per JSON GET schema, answered with 504.  0 disables.
+            'biz_words': config('QUERY_TIMEOUT_BIZ_WORDS', default=10000, cast=int),
+            'biz_comp': config('QUERY_TIMEOUT_BIZ_COMP', default=5000, cast=int),
+            'biz_stats': config('QUERY_TIMEOUT_BIZ_STATS', default=5000, cast=int),
+            'top_tokens': config('QUERY_TIMEOUT_TOP_TOKENS', default=5000, cast=int),
+            'search_reviews': config('QUERY_TIMEOUT_SEARCH_REVIEWS', default=5000, cast=int),
+            },
+        STREAM_TIMEOUT_MS=config('STREAM_TIMEOUT_MS', default=120000, cast=int),  # Statement timeout for streamed and Arrow/Parquet GETs.  0 disables.
+        DB_POOL_SIZE=config('DB_POOL_SIZE', default=5, cast=int),  # Connections kept open per worker process
+        DB_MAX_OVERFLOW=config('DB_MAX_OVERFLOW', default=10, cast=int),  # Extra connections allowed under burst load
+        DB_POOL_TIMEOUT=config('DB_POOL_TIMEOUT', default=30, cast=int),  # Seconds to wait for a free connection
+        DB_POOL_PRE_PING=config('DB_POOL_PRE_PING', default=True, cast=bool),  # Test connections on checkout
+        DB_POOL_RECYCLE=config('DB_POOL_RECYCLE', default=1800, cast=int),  # Seconds before a connection is replaced
+        WRITE_GROUP_MAX_RECORDS=config('WRITE_GROUP_MAX_RECORDS', default=1000, cast=int),  # Records per group commit
+        WRITE_TIMEOUT=config('WRITE_TIMEOUT', default=100, cast=int),  # Seconds a POST waits for its commit
+        INGEST_WORKERS=config('INGEST_WORKERS', default=4, cast=int),  # Async POST batches applied at once
+        INGEST_MAX_PENDING=config('INGEST_MAX_PENDING', default=200, cast=int),  # Queued async batches before 503
+        ASGI_MAX_CONCURRENCY=config('ASGI_MAX_CONCURRENCY', default=0, cast=int),  # Queries in flight per ASGI worker.  0: pool size + overflow
+        STREAM_BATCH_SIZE=config('STREAM_BATCH_SIZE', default=500, cast=int),  # Records per commit for NDJSON uploads
+        COMPRESS_RESPONSES=config('COMPRESS_RESPONSES', default=True, cast=bool),  # gzip/zstd responses for clients that accept them
+        COMPRESS_MIN_BYTES=config('COMPRESS_MIN_BYTES', default=1024, cast=int),  # Smaller responses are sent as is
+        COMPRESS_GZIP_LEVEL=config('COMPRESS_GZIP_LEVEL', default=3, cast=int),  # 1-9.  Above 3 costs much more CPU for little gain on JSON
+        COMPRESS_ZSTD_LEVEL=config('COMPRESS_ZSTD_LEVEL', default=3, cast=int),  # Used when zstandard is installed
+        MAX_DECOMPRESSED_BYTES=config('MAX_DECOMPRESSED_BYTES', default=256 * 1024 * 1024, cast=int),  # Largest inflated request body
+        FINGERPRINT_MAX_ROWS=config('FINGERPRINT_MAX_ROWS', default=100000, cast=int),  # Applied batch fingerprints kept for retries.  0 disables
     )
+    if test_config is not None:
+        # Override settings for tests and benchmarks
+        app.config.from_mapping(test_config)
     # Enable CORS extensions
     CORS(app)
     # Enable caching
     cache = Cache(app)
 
-    #  Register database functions.  Will allow db.close() to run on instance teardown.
+    #  Per-request latency, SQL and row counts.  Served at /metrics.
+    import metrics
+    metrics.init_app(app)
+
+    #  gzip/zstd request bodies and negotiated response encoding.  After metrics so its time is counted.
+    import compression
+    compression.init_app(app)
+
+    #  Register database functions.  Engine and pool are shared by the whole worker process.
     import db
     db.init_app(app)
 
+    #  GET responses cached per (schema, params).  Invalidated by POSTs to the same business.
+    import response_cache
+    response_cache.init_app(app, cache)
+
     #  Bring in query methods
     import query
+    metrics.register_schemas(query.POST_TABLES + query.GET_SCHEMAS)
+
+    #  Start group-commit writer (one thread per table, started on first POST)
+    import writer
+    import fingerprints
+    writer.init_app(app, apply=query.apply_batch, applied=fingerprints.stored)
+
+    #  Background pool for async POST (ingestion tickets)
+    import ingest
+    ingest.init_app(app)
 
     ############
     ###Routes###
@@ -76,6 +142,7 @@ def create_app(test_config=None):
                 raise InvalidUsage(message="Search query not provided")
             # Pass json portion of request to database query handler
             search_request = request.json
+            metrics.label(search_request.get('schema'))
             search_response = query.query_database(method='GET', query=search_request)
         elif request.method == 'POST':
             if not request.json:
@@ -83,11 +150,73 @@ def create_app(test_config=None):
             # Pass json portion of request to database query handler
             app_logger.info('POST Request recognized.  Sending to query handler.')
             search_request = request.json
+            data = search_request.get('data')
+            # Counted only for a list of records.  Anything else is refused by validate_post.
+            metrics.label(search_request.get('table_name'), rows_in=len(data) if type(data) == list else 0)
+            if search_request.get('async'):
+                # Validate, ticket and return.  Valid records are applied in the background.
+                query.validate_post(search_request)
+                duplicate = fingerprints.find_applied(search_request)
+                if duplicate is not None:
+                    return json_response(duplicate)
+                records, rejected = query.check_post(search_request)
+                return json_response(ingest.submit_ticket(
+                    search_request['table_name'], records, rejected,
+                    fingerprint=fingerprints.parse(search_request)), status=202)
             search_response = query.query_database(method='POST', query=search_request)
         else:
             raise InvalidUsage(message="Incorrect request type")
 
-        return search_response
+        if isinstance(search_response, Response):
+            # Streamed and columnar responses are already encoded
+            return search_response
+        if request.method == 'GET':
+            metrics.record_rows_out(search_response)
+        with metrics.timed('serialize_seconds'):
+            return json_response(search_response)
+
+    @app.route('/api/data/stream', methods=['POST'])
+    def data_stream():
+        # Newline-delimited JSON upload for one table: /api/data/stream?table_name=reviews
+        table_name = request.args.get('table_name')
+        query.validate_post({'table_name': table_name, 'data': []})
+        app_logger.info('NDJSON stream for {} received.  Processing.'.format(table_name))
+        result = ingest.stream_ingest(
+            stream=request.stream,
+            table_name=table_name,
+            content_encoding=request.headers.get('Content-Encoding'),
+            batch_size=app.config['STREAM_BATCH_SIZE'],
+            )
+        metrics.label(table_name, rows_in=result['records'])
+        return json_response(result)
+
+    @app.route('/api/ingest/<ticket_id>')
+    def ingest_status(ticket_id):
+        # Applied/failed record counts for an async POST
+        return json_response(ingest.get_ticket(ticket_id))
+
+    @app.route('/api/status')
+    def status():
+        # Monitoring: connection pool and writer queues for this worker process
+        return json_response({
+            'pool': db.pool_status(),
+            'writer': writer.get_coordinator().status(),
+            'ingest': ingest.get_pool().status(),
+            })
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        # Prometheus scrape target.  Histograms and counters are per worker process.
+        pool = db.pool_status()
+        writer_status = writer.get_coordinator().status()
+        gauges = {
+            'db_api_pool_checked_out': ('Connections checked out of the pool', {
+                'engine="{}"'.format(uri): engine['checked_out'] or 0 for uri, engine in pool['engines'].items()}),
+            'db_api_pool_wait_seconds_max': ('Longest pool checkout wait', {'': pool['wait_max']}),
+            'db_api_writer_queue_depth': ('Batches waiting for group commit', {
+                'table="{}"'.format(table): stats['queue_depth'] for table, stats in writer_status.items()}),
+        }
+        return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
 
     #############
     ###Logging###
@@ -106,9 +235,7 @@ def create_app(test_config=None):
     ############################
     @app.errorhandler(InvalidUsage)
     def handle_invalid_usage(error):
-        response = jsonify(error.to_dict())
-        response.status_code = error.status_code
-        return response
+        return json_response(error.to_dict(), status=error.status_code)
 
     return app
 
@@ -0,0 +1,141 @@
+"""
+ASGI Entry Point
+    Alternative serving mode for db_api:  uvicorn asgi:app --workers 2
+
+    Request bodies are read on the event loop and each request is answered by the Flask app,
+    through a small WSGI bridge, in a thread pool sized to the connection pool
+    (ASGI_MAX_CONCURRENCY).  One worker can hold many slow dashboard GETs open at once, and
+    requests beyond the pool limit wait on a semaphore instead of tying up a worker.
+    SQLAlchemy 1.3 has no asyncio support, so the database calls themselves stay synchronous
+    in those threads.
+
+    Every response goes through the Flask app's route checks and hooks (CORS, metrics,
+    compression), so the /api/data contract is unchanged.  Bodies are buffered: send large
+    NDJSON uploads and streamed exports to the gunicorn (app.py) deployment.
+"""
+import asyncio
+import io
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+asgi_logger = logging.getLogger(__name__)
+
+
+class ASGIApp():
+    """ASGI application wrapping a db_api Flask app.
+
+    param flask_app: App from app.create_app()
+    param max_concurrency: Queries run at once.  Defaults to ASGI_MAX_CONCURRENCY, else the
+        pool size plus overflow.
+    """
+    def __init__(self, flask_app, max_concurrency=None):
+        self.flask_app = flask_app
+        config = flask_app.config
+        self.max_concurrency = max_concurrency or config.get('ASGI_MAX_CONCURRENCY') or \
+            config['DB_POOL_SIZE'] + config['DB_MAX_OVERFLOW']
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='asgi')
+        self.semaphore = None  # Created on the running loop
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        body = await read_body(receive)
+        async with self.semaphore:
+            status, headers, chunks = await self.run(self.call_wsgi, scope, body)
+        await respond(send, status, headers, chunks)
+
+    async def run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    ###Worker Thread###
+    def call_wsgi(self, scope, body):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+        iterable = self.flask_app.wsgi_app(wsgi_environ(scope, body), start_response)
+        try:
+            chunks = list(iterable)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        return response['status'], response['headers'], chunks
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def respond(send, status, headers, chunks):
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+
+
+def wsgi_environ(scope, body):
+    """Minimal PEP 3333 environ for an ASGI HTTP scope with a buffered body."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def create_asgi_app(flask_app, max_concurrency=None):
+    return ASGIApp(flask_app, max_concurrency)
+
+
+def __getattr__(name):
+    # uvicorn asgi:app builds the Flask app from the environment on first access
+    if name == 'app':
+        from app import app as flask_app
+        globals()['app'] = create_asgi_app(flask_app)
+        return globals()['app']
+    raise AttributeError(name)
@@ -0,0 +1,119 @@
+"""
+Sync vs ASGI serving benchmark
+    Fires the same mix of biz_words/biz_stats GETs at one sync worker (Flask, one request
+    at a time, as under gunicorn's sync worker class) and at one ASGI worker (asgi.py,
+    called in-process with `clients` concurrent requests).  Response caching is off so every
+    request reaches the database.
+
+    latency_ms adds a sleep to every SQL statement to stand in for the network round trip
+    to a remote database.  At 0 (local SQLite) the two modes are close.  The ASGI mode pulls
+    ahead as database latency grows.
+
+Usage: python benchmarks/bench_asgi.py [requests] [clients] [latency_ms]
+"""
+import asyncio
+import random
+import statistics
+import sys
+import time
+
+import ujson
+from sqlalchemy import event
+
+from common import make_app, make_records, random_id, Timer
+
+
+def build(n_businesses=50, reviews_per_business=100):
+    app = make_app(CACHE_SCHEMA_TIMEOUTS={}, DB_POOL_SIZE=8, DB_MAX_OVERFLOW=8)
+    import query
+    business_ids = [random_id() for _ in range(n_businesses)]
+    records = make_records('reviews', n_businesses * reviews_per_business, business_ids, [random_id()])
+    with app.app_context():
+        for i in range(0, len(records), 1000):
+            query.Post(query={'table_name': 'reviews', 'data': records[i:i + 1000]})
+    return app, business_ids
+
+
+def add_latency(app, latency_ms):
+    import db
+    with app.app_context():
+        engine = db.get_db('read')
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def sleep(*args):
+        time.sleep(latency_ms / 1e3)
+
+
+def payloads(business_ids, n):
+    schemas = ['biz_words', 'biz_stats']
+    return [{'schema': random.choice(schemas), 'params': {'business_id': random.choice(business_ids)}}
+            for _ in range(n)]
+
+
+def run_sync(app, requests):
+    client = app.test_client()
+    latencies = []
+    with Timer() as total:
+        for payload in requests:
+            with Timer() as t:
+                assert client.get('/api/data', json=payload).status_code == 200
+            latencies.append(t.elapsed)
+    return total.elapsed, latencies
+
+
+def run_asgi(app, requests, clients):
+    import asgi
+    asgi_app = asgi.create_asgi_app(app)
+
+    async def call(payload):
+        body = ujson.dumps(payload).encode()
+        scope = {'type': 'http', 'method': 'GET', 'path': '/api/data', 'query_string': b'',
+                 'headers': [(b'content-type', b'application/json')]}
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+        await asgi_app(scope, receive, send)
+        assert sent[0]['status'] == 200
+
+    async def main():
+        limit = asyncio.Semaphore(clients)
+        latencies = []
+
+        async def client(payload):
+            async with limit:
+                start = time.perf_counter()
+                await call(payload)
+                latencies.append(time.perf_counter() - start)
+        await asyncio.gather(*[client(payload) for payload in requests])
+        return latencies
+
+    with Timer() as total:
+        latencies = asyncio.run(main())
+    return total.elapsed, latencies
+
+
+def report(name, elapsed, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print('{:<8}{:>10.0f}{:>12.1f}{:>12.1f}'.format(
+        name, len(latencies) / elapsed, statistics.median(latencies) * 1e3, p95 * 1e3))
+
+
+def run(n=400, clients=32, latency_ms=5):
+    app, business_ids = build()
+    if latency_ms:
+        add_latency(app, latency_ms)
+    requests = payloads(business_ids, n)
+    print('{} GETs, {} ASGI clients, {} ms per statement'.format(n, clients, latency_ms))
+    print('{:<8}{:>10}{:>12}{:>12}'.format('mode', 'req/s', 'p50 ms', 'p95 ms'))
+    report('sync', *run_sync(app, requests))
+    report('asgi', *run_asgi(app, requests, clients))
+
+
+if __name__ == "__main__":
+    args = [int(x) for x in sys.argv[1:4]]
+    run(*args)
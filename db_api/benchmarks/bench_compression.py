@@ -0,0 +1,95 @@
+"""
+Compressed bodies benchmark
+    POSTs review batches (text and token columns) and GETs biz_words for busy businesses,
+    uncompressed and with each supported Content-Encoding.  Reports bytes on the wire and
+    the end-to-end time per request: client encode/decode + server + transfer.  The app runs
+    in-process, so transfer time is estimated from the body size at mbit_per_s.
+
+Usage: python benchmarks/bench_compression.py [records per POST] [requests] [mbit_per_s]
+"""
+import gzip
+import json
+import sys
+
+from common import make_app, make_records, random_id, Timer
+
+import compression
+
+
+def encoders():
+    modes = {'identity': (lambda body: body, lambda body: body)}
+    modes['gzip'] = (lambda body: gzip.compress(body, compresslevel=3), gzip.decompress)
+    if 'zstd' in compression.ENCODINGS:
+        zstandard = compression.zstandard
+        modes['zstd'] = (zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress)
+    return modes
+
+
+def bench_post(app, business_ids, size, n, mbit):
+    client = app.test_client()
+    rows = []
+    for mode, (encode, _) in encoders().items():
+        packages = [{'table_name': 'reviews', 'data': make_records('reviews', size, business_ids, [random_id()])}
+                    for _ in range(n)]
+        sent = raw = client_seconds = server_seconds = 0
+        for package in packages:
+            with Timer() as t:
+                raw_body = json.dumps(package).encode()
+                body = encode(raw_body)
+            headers = {'Content-Type': 'application/json'}
+            if mode != 'identity':
+                headers['Content-Encoding'] = mode
+            with Timer() as s:
+                assert client.post('/api/data', data=body, headers=headers).status_code == 200
+            raw, sent = raw + len(raw_body), sent + len(body)
+            client_seconds, server_seconds = client_seconds + t.elapsed, server_seconds + s.elapsed
+        rows.append((mode, raw, sent, client_seconds, server_seconds, n))
+    report('POST reviews x{}'.format(size), rows, mbit)
+
+
+def bench_get(app, business_ids, n, mbit):
+    client = app.test_client()
+    rows = []
+    payloads = [{'schema': 'biz_words', 'params': {'business_id': business_ids[i % len(business_ids)]}}
+                for i in range(n)]
+    for mode, (_, decode) in encoders().items():
+        raw = sent = client_seconds = server_seconds = 0
+        for payload in payloads:
+            with Timer() as s:
+                response = client.get('/api/data', json=payload, headers={'Accept-Encoding': mode})
+            assert response.status_code == 200
+            assert response.headers.get('Content-Encoding', 'identity') == mode
+            with Timer() as t:
+                body = decode(response.data)
+            raw, sent = raw + len(body), sent + len(response.data)
+            client_seconds, server_seconds = client_seconds + t.elapsed, server_seconds + s.elapsed
+        rows.append((mode, raw, sent, client_seconds, server_seconds, n))
+    report('GET biz_words', rows, mbit)
+
+
+def report(title, rows, mbit):
+    print('\n' + title)
+    print('{:<10}{:>12}{:>12}{:>8}{:>11}{:>11}{:>13}{:>10}'.format(
+        'encoding', 'raw KB', 'sent KB', 'ratio', 'client ms', 'server ms', 'transfer ms', 'total ms'))
+    baseline = None
+    for mode, raw, sent, client_seconds, server_seconds, n in rows:
+        transfer = sent * 8 / (mbit * 1e6)
+        total = (client_seconds + server_seconds + transfer) / n * 1e3
+        baseline = baseline or total
+        print('{:<10}{:>12.0f}{:>12.0f}{:>8.1f}{:>11.2f}{:>11.2f}{:>13.2f}{:>10.2f}  {:+.0f}%'.format(
+            mode, raw / n / 1024, sent / n / 1024, raw / sent, client_seconds / n * 1e3,
+            server_seconds / n * 1e3, transfer / n * 1e3, total, (total - baseline) / baseline * 100))
+
+
+def run(size=1000, n=10, mbit=100):
+    # Response caching off: every GET is encoded again
+    app = make_app(CACHE_SCHEMA_TIMEOUTS={})
+    business_ids = [random_id() for _ in range(5)]
+    print('{} records per POST, {} requests per encoding, {} Mbit/s link'.format(size, n, mbit))
+    bench_post(app, business_ids, size, n, mbit)
+    bench_get(app, business_ids, n, mbit)
+
+
+if __name__ == "__main__":
+    args = [int(x) for x in sys.argv[1:4]]
+    run(*args)
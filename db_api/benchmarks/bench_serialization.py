@@ -0,0 +1,58 @@
+"""
+Serialization microbenchmark
+    Encodes a large biz_words response (real SQLAlchemy rows with datetimes) and a
+    word-count payload with numpy values using Flask's JSON encoder (stdlib json for numpy)
+    and serializer.dumps.
+
+Usage: python benchmarks/bench_serialization.py [rows] [rounds]
+"""
+import statistics
+import sys
+
+import numpy as np
+from flask import json
+
+from common import make_app, make_records, random_id, Timer, WORDS
+
+
+def time_encoder(encode, payload, rounds):
+    samples = []
+    for _ in range(rounds):
+        with Timer() as t:
+            encode(payload)
+        samples.append(t.elapsed * 1e3)
+    return statistics.median(samples)
+
+
+def run(n=100000, rounds=5):
+    app = make_app(QUERY_MAX_ROWS={})  # One unpaged response with every row
+    import db
+    import query
+    import serializer
+    business_id = random_id()
+    records = make_records('reviews', n, [business_id], [random_id()])
+    with app.app_context():
+        query.Post(query={'table_name': 'reviews', 'data': records})
+        with db.get_session() as session:
+            biz_words = query.biz_words(session, {'business_id': business_id})
+        word_counts = {str(i): [{'word': w, 'count': np.float64(i), 'pct_total': np.float64(0.1),
+                                 'rank': np.int64(r), 'star_review': np.float64(3.5)}
+                                for r, w in enumerate(WORDS)] for i in range(n // len(WORDS))}
+        payloads = {'biz_words': biz_words, 'word_counts': word_counts}
+
+        # Baselines: Flask's encoder for rows, stdlib json for numpy values (Flask's encoder rejects them)
+        baselines = {
+            'biz_words': json.dumps,
+            'word_counts': lambda payload: json.dumps(payload, default=serializer.default),
+        }
+        print('{:<14}{:>14}{:>14}{:>10}'.format('payload', 'baseline ms', 'serializer ms', 'speedup'))
+        for name, payload in payloads.items():
+            baseline_ms = time_encoder(baselines[name], payload, rounds)
+            fast_ms = time_encoder(serializer.dumps, payload, rounds)
+            print('{:<14}{:>14.1f}{:>14.1f}{:>9.1f}x'.format(name, baseline_ms, fast_ms, baseline_ms / fast_ms))
+        print('serializer backend: {}'.format('orjson' if serializer.orjson else 'json'))
+
+
+if __name__ == "__main__":
+    args = [int(x) for x in sys.argv[1:3]]
+    run(*args)
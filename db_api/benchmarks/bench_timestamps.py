@@ -0,0 +1,68 @@
+"""
+Datetime coercion benchmark
+    Converts the date column of reviews packages with the old per-record convert_to_datetime
+    (copied below) and with timestamps.coerce_datetime_columns, for epoch-millisecond and
+    ISO 8601 payloads.
+
+Usage: python benchmarks/bench_timestamps.py [records] [rounds]
+"""
+import logging
+import statistics
+import sys
+from datetime import datetime
+
+from common import make_records, random_id, Timer
+
+import timestamps
+
+
+legacy_logger = logging.getLogger('legacy')
+
+
+def convert_to_datetime(time_string):
+    # Per-record conversion replaced by timestamps.py
+    legacy_logger.debug('Converting {} to datetime'.format(time_string))
+    try:
+        assert type(time_string) == str
+        return datetime.fromisoformat(time_string)
+    except ValueError:
+        legacy_logger.debug('Value Error: Invalid isoformat string')
+        legacy_logger.debug('Sending default datetime')
+        return datetime.fromisoformat('1969-01-01')
+    except AssertionError:
+        legacy_logger.debug('AssertionError: DateTime not a string.')
+        legacy_logger.debug('Attempting translation')
+        return datetime.fromtimestamp(time_string / 1e3)
+
+
+def legacy(records):
+    for record in records:
+        for field in ['date', 'yelping_since']:
+            if field in record.keys():
+                record[field] = convert_to_datetime(record[field])
+
+
+def time_converter(convert, records, rounds):
+    samples = []
+    for _ in range(rounds):
+        batch = [dict(record) for record in records]
+        with Timer() as t:
+            convert(batch)
+        samples.append(t.elapsed * 1e3)
+    return statistics.median(samples), batch
+
+
+def run(n=100000, rounds=5):
+    epoch = make_records('reviews', n, [random_id()], [random_id()])
+    iso = [dict(record, date=datetime.fromtimestamp(record['date'] / 1e3).isoformat()) for record in epoch]
+    print('{:<10}{:>12}{:>12}{:>10}'.format('payload', 'legacy ms', 'batch ms', 'speedup'))
+    for name, records in [('epoch_ms', epoch), ('iso', iso)]:
+        legacy_ms, expected = time_converter(legacy, records, rounds)
+        batch_ms, converted = time_converter(timestamps.coerce_datetime_columns, records, rounds)
+        assert [r['date'] for r in expected] == [r['date'] for r in converted], 'Results differ'
+        print('{:<10}{:>12.1f}{:>12.1f}{:>9.1f}x'.format(name, legacy_ms, batch_ms, legacy_ms / batch_ms))
+
+
+if __name__ == "__main__":
+    args = [int(x) for x in sys.argv[1:3]]
+    run(*args)
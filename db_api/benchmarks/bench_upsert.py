@@ -0,0 +1,54 @@
+"""
+Bulk upsert benchmark
+    Posts synthetic batches for every table through query.Post against SQLite and
+    reports records/sec for an insert pass and an update pass (same keys).  Records are
+    validated before the timer starts, as the writer receives them.
+
+Usage: python benchmarks/bench_upsert.py [records_per_table] [batch_size]
+"""
+import sys
+
+from common import make_app, make_records, random_id, validated, Timer
+
+TABLES = ['businesses', 'users', 'checkins', 'photos', 'tips', 'reviews',
+          'review_sentiment', 'tip_sentiment', 'viz2']
+
+
+def post_batches(table_name, records, batch_size):
+    import query
+    for i in range(0, len(records), batch_size):
+        query.Post(query={'table_name': table_name, 'data': records[i:i + batch_size]})
+
+
+def run(n=2000, batch_size=50):
+    app = make_app()
+    business_ids = [random_id() for _ in range(200)]
+    user_ids = [random_id() for _ in range(500)]
+    review_ids = [random_id() for _ in range(n)]
+    tip_ids = [random_id() for _ in range(n)]
+    keys = {
+        'businesses': business_ids + [random_id() for _ in range(n - len(business_ids))],
+        'users': user_ids + [random_id() for _ in range(n - len(user_ids))],
+        'reviews': review_ids,
+        'review_sentiment': review_ids,
+        'tips': tip_ids,
+        'tip_sentiment': tip_ids,
+        'viz2': business_ids * (n // len(business_ids) + 1),
+    }
+
+    print('{:<18}{:>14}{:>14}'.format('table', 'insert rec/s', 'update rec/s'))
+    with app.app_context():
+        for table_name in TABLES:
+            ids = keys.get(table_name) or [random_id() for _ in range(n)]
+            rates = []
+            for _ in ('insert', 'update'):
+                records = validated(table_name, make_records(table_name, n, business_ids, user_ids, ids=ids[:n]))
+                with Timer() as t:
+                    post_batches(table_name, records, batch_size)
+                rates.append(n / t.elapsed)
+            print('{:<18}{:>14.0f}{:>14.0f}'.format(table_name, *rates))
+
+
+if __name__ == "__main__":
+    args = [int(x) for x in sys.argv[1:3]]
+    run(*args)
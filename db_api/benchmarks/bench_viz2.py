@@ -0,0 +1,108 @@
+"""
+biz_comp latency benchmark
+    Loads legacy string-encoded viz2 rows, times the old per-request parsing biz_comp,
+    runs the viz2 migration and times the new biz_comp on the same businesses.
+
+Usage: python benchmarks/bench_viz2.py [businesses] [rounds]
+"""
+import re
+import statistics
+import sys
+
+import ujson
+from sqlalchemy import Text, text, type_coerce
+
+from common import make_app, make_records, random_id, Timer
+from models import Business, Viz2
+
+
+def legacy_biz_comp(session, params):
+    # biz_comp before viz2 fields were stored as JSON (regex, split, ujson and eval per request)
+    # Same ORM query as before, with the viz2 columns read back as raw Text
+    raw = {c: type_coerce(getattr(Viz2, c), Text).label(c) for c in (
+        'competitors', 'bestinsector', 'avg_stars_over_time', 'chunk_sentiment',
+        'count_by_star', 'review_by_year')}
+    response = session.query(
+            Business.business_id, Business.address, Business.city, Business.state,
+            Business.postal_code, Business.review_count, Viz2.categories, Viz2.percentile,
+            raw['competitors'], raw['bestinsector'], raw['avg_stars_over_time'], raw['chunk_sentiment'],
+            raw['count_by_star'], raw['review_by_year']).\
+            join(Viz2).filter(Business.business_id == params['business_id']).all()
+    response = response[0]
+
+    def get_components(element):
+        return re.findall(r'\[([^]]+)\]', element)
+    def strip_json_artifacts(element):
+        return element.strip().strip("'")
+
+    avg_stars_components = get_components(response.avg_stars_over_time)
+    dates = [strip_json_artifacts(x) for x in avg_stars_components[1].split(',')]
+    avg_stars = [float(x) for x in avg_stars_components[0].split(',')]
+    chunk_sentiment_components = get_components(response.chunk_sentiment)
+    noun_chunks = [strip_json_artifacts(x) for x in chunk_sentiment_components[0].split(',')]
+    chunk_sentiment = [float(strip_json_artifacts(x)) for x in chunk_sentiment_components[1].split(',')]
+    return {
+        'business_id': response.business_id,
+        'competitors': [strip_json_artifacts(x) for x in ujson.loads(
+                        response.competitors).strip('[]').split(',')],
+        'bestinsector': [strip_json_artifacts(x) for x in ujson.loads(
+                        response.bestinsector).strip("[]").split(',')],
+        'avg_stars': avg_stars,
+        'dates': dates,
+        'noun_chunks': noun_chunks,
+        'chunk_sentiment': chunk_sentiment,
+        'count_by_star': eval(response.count_by_star),
+        'review_by_year': eval(response.review_by_year),
+    }
+
+
+def time_calls(function, session, business_ids, rounds):
+    samples = []
+    for _ in range(rounds):
+        for business_id in business_ids:
+            with Timer() as t:
+                function(session, {'business_id': business_id})
+            samples.append(t.elapsed * 1e6)
+    return statistics.mean(samples), statistics.median(samples)
+
+
+def run(n=200, rounds=20):
+    app = make_app()
+    import db
+    import query
+    import viz2
+    business_ids = [random_id() for _ in range(n)]
+    with app.app_context():
+        engine = db.get_db()
+        # Legacy rows exactly as the old write path stored them: str() of nested dicts
+        records = make_records('viz2', n, business_ids, business_ids, ids=business_ids)
+        with engine.begin() as connection:
+            connection.execute(text('INSERT INTO businesses (business_id) VALUES (:business_id)'),
+                               [{'business_id': b} for b in business_ids])
+            for record in records:
+                for key, value in record.items():
+                    if type(value) == dict:
+                        record[key] = str(value)
+            connection.execute(text(
+                'INSERT INTO viz2 (business_id, categories, percentile, competitors, bestinsector, '
+                'avg_stars_over_time, chunk_sentiment, count_by_star, review_by_year) VALUES '
+                '(:business_id, :categories, :percentile, :competitors, :bestinsector, '
+                ':avg_stars_over_time, :chunk_sentiment, :count_by_star, :review_by_year)'), records)
+
+        with db.get_session() as session:
+            legacy = time_calls(legacy_biz_comp, session, business_ids, rounds)
+        with Timer() as t:
+            viz2.migrate(engine)
+        with db.get_session() as session:
+            assert query.biz_comp(session, {'business_id': business_ids[0]}) is not None
+            new = time_calls(query.biz_comp, session, business_ids, rounds)
+
+    print('Migrated {} viz2 rows in {:.3f}s'.format(n, t.elapsed))
+    print('{:<10}{:>12}{:>12}'.format('biz_comp', 'mean us', 'median us'))
+    print('{:<10}{:>12.0f}{:>12.0f}'.format('legacy', *legacy))
+    print('{:<10}{:>12.0f}{:>12.0f}'.format('json', *new))
+
+
+if __name__ == "__main__":
+    args = [int(x) for x in sys.argv[1:3]]
+    run(*args)
@@ -0,0 +1,115 @@
+"""
+Shared helpers for db_api benchmarks.
+    Run benchmark scripts from the db_api directory, e.g. python benchmarks/bench_upsert.py
+"""
+import os
+import sys
+import random
+import string
+import tempfile
+import time
+
+# Benchmarks import the flat db_api modules (app, db, query, models)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = ['good', 'great', 'food', 'service', 'slow', 'friendly', 'price', 'clean',
+         'tacos', 'coffee', 'pizza', 'wait', 'staff', 'rude', 'amazing', 'parking']
+
+
+def random_id(length=22):
+    return ''.join(random.choices(string.ascii_letters + string.digits + '-_', k=length))
+
+
+def random_epoch_ms():
+    # Dates arrive from DataFrame.to_json as epoch milliseconds
+    return random.randint(1262304000, 1546300800) * 1000
+
+
+def random_text(n_words=40):
+    return ' '.join(random.choices(WORDS, k=n_words))
+
+
+def make_app(db_path=None, **config):
+    """Create a db_api app against a fresh SQLite file and build the tables."""
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+    from app import create_app
+    settings = {'DATABASE_URI': 'sqlite:///' + db_path}
+    settings.update(config)
+    app = create_app(settings)
+    with app.app_context():
+        import db
+        db.init_db()
+    return app
+
+
+def validated(table_name, records):
+    """records as the writer receives them: checked, coerced and (viz2) parsed by validation.
+    Benchmarks that call query.Post directly must pass records through here first.
+    """
+    from validators import validate_records
+    valid, rejected = validate_records(table_name, records)
+    if rejected:
+        raise ValueError('{} {} records rejected: {}'.format(len(rejected), table_name, rejected[0]))
+    return valid
+
+
+def make_records(table_name, n, business_ids, user_ids, ids=None):
+    """Generate n records shaped like write_on_job packages for table_name.
+    Pass ids to regenerate the same keys (update workload).
+    """
+    ids = ids or [random_id() for _ in range(n)]
+    records = []
+    for i in range(n):
+        business_id = random.choice(business_ids)
+        user_id = random.choice(user_ids)
+        if table_name == 'businesses':
+            record = {'business_id': ids[i], 'name': random_text(3), 'city': 'Phoenix',
+                      'state': 'AZ', 'latitude': random.random(), 'longitude': random.random(),
+                      'review_count': random.randint(0, 500), 'stars': random.randint(1, 5),
+                      'is_open': 1, 'categories': 'Restaurants, Mexican'}
+        elif table_name == 'users':
+            record = {'user_id': ids[i], 'name': random_text(1), 'review_count': random.randint(0, 100),
+                      'average_stars': random.uniform(1, 5), 'yelping_since': random_epoch_ms(),
+                      'fans': random.randint(0, 10), 'useful': random.randint(0, 10)}
+        elif table_name == 'checkins':
+            record = {'checkin_id': ids[i], 'dates': '2016-04-26 19:49:16, 2016-08-30 18:36:57',
+                      'business_id': business_id}
+        elif table_name == 'photos':
+            record = {'photo_id': ids[i], 'caption': random_text(5), 'label': 'food',
+                      'business_id': business_id}
+        elif table_name == 'tips':
+            record = {'tip_id': ids[i], 'compliment_count': 0, 'date': random_epoch_ms(),
+                      'text': random_text(15), 'business_id': business_id, 'user_id': user_id}
+        elif table_name == 'reviews':
+            record = {'review_id': ids[i], 'date': random_epoch_ms(), 'stars': float(random.randint(1, 5)),
+                      'cool': 0, 'funny': 0, 'useful': random.randint(0, 3), 'text': random_text(),
+                      'token': str(random.choices(WORDS, k=20)),
+                      'business_id': business_id, 'user_id': user_id}
+        elif table_name == 'review_sentiment':
+            record = {'review_id': ids[i], 'polarity': random.uniform(-1, 1),
+                      'subjectivity': random.random()}
+        elif table_name == 'tip_sentiment':
+            record = {'tip_id': ids[i], 'polarity': random.uniform(-1, 1),
+                      'subjectivity': random.random()}
+        elif table_name == 'viz2':
+            record = {'business_id': ids[i], 'categories': 'Restaurants', 'percentile': random.random(),
+                      'competitors': '"{}"'.format([random_id() for _ in range(5)]),
+                      'bestinsector': '"{}"'.format([random_id() for _ in range(5)]),
+                      'avg_stars_over_time': str(([3.5, 4.0, 4.5], ['2017-01-01', '2018-01-01', '2019-01-01'])),
+                      'chunk_sentiment': str((['the food', 'the staff'], [0.5, -0.2])),
+                      'count_by_star': {1: 3, 2: 5, 3: 10, 4: 20, 5: 40},
+                      'review_by_year': {2017: 30, 2018: 25, 2019: 23}}
+        else:
+            raise KeyError(table_name)
+        records.append(record)
+    return records
+
+
+class Timer():
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
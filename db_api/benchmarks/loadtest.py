@@ -0,0 +1,238 @@
+"""
+Load test
+    Generates a skewed synthetic Yelp dataset (review and tip counts per business follow a
+    Zipf-like curve, as in the real data), loads it into db_api running in-process on a
+    temporary SQLite database, then drives a configurable GET/POST mix from concurrent
+    clients.  Reports throughput and p50/p95/p99 latency per schema and table, and writes
+    them as JSON so runs on two commits can be compared with --compare.
+
+Usage:
+    python benchmarks/loadtest.py --requests 2000 --clients 8 --output results.json
+    python benchmarks/loadtest.py --mix biz_words:50,reviews:50 --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from common import make_app, make_records, random_id, validated, Timer, WORDS
+
+
+GET_SCHEMAS = ('biz_words', 'biz_comp', 'biz_stats', 'top_tokens', 'search_reviews')
+POST_TABLES = ('reviews', 'tips', 'users', 'review_sentiment')
+DEFAULT_MIX = 'biz_words:30,biz_comp:15,biz_stats:10,top_tokens:10,search_reviews:5,reviews:20,tips:10'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--businesses', type=int, default=500)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--reviews', type=int, default=50000)
+    parser.add_argument('--tips', type=int, default=10000)
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent for activity per business')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='operation:weight,...  GET schemas or POST tables')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent client threads')
+    parser.add_argument('--post-batch', type=int, default=50, help='Records per POST')
+    parser.add_argument('--no-cache', action='store_true', help='Disable GET response caching')
+    parser.add_argument('--seed', type=int, default=18)
+    parser.add_argument('--output', help='Write results as JSON')
+    parser.add_argument('--compare', help='Earlier results JSON to compare against')
+    return parser.parse_args(argv)
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        name, weight = item.split(':')
+        if name not in GET_SCHEMAS + POST_TABLES:
+            raise SystemExit('Unknown operation {}.  Choose from {}'.format(name, ', '.join(GET_SCHEMAS + POST_TABLES)))
+        weights[name] = float(weight)
+    return weights
+
+
+###Dataset###
+class Dataset():
+    """Synthetic businesses, users, reviews, tips and viz2 rows with skewed activity."""
+    def __init__(self, args):
+        self.business_ids = [random_id() for _ in range(args.businesses)]
+        self.user_ids = [random_id() for _ in range(args.users)]
+        # Rank r gets weight 1 / r^skew: a few businesses hold most of the reviews
+        weights = [1 / (rank + 1) ** args.skew for rank in range(args.businesses)]
+        self.skewed_business_ids = random.choices(self.business_ids, weights=weights, k=10000)
+        user_weights = [1 / (rank + 1) ** args.skew for rank in range(args.users)]
+        self.skewed_user_ids = random.choices(self.user_ids, weights=user_weights, k=10000)
+        self.review_ids = []
+        self.args = args
+
+    def load(self, app):
+        import query
+        args = self.args
+        tables = [
+            ('businesses', make_records('businesses', args.businesses, self.business_ids, self.user_ids,
+                                        ids=self.business_ids)),
+            ('users', make_records('users', args.users, self.business_ids, self.user_ids, ids=self.user_ids)),
+            ('reviews', make_records('reviews', args.reviews, self.skewed_business_ids, self.skewed_user_ids)),
+            ('tips', make_records('tips', args.tips, self.skewed_business_ids, self.skewed_user_ids)),
+            ('viz2', make_records('viz2', args.businesses, self.business_ids, self.user_ids, ids=self.business_ids)),
+        ]
+        self.review_ids = [record['review_id'] for record in tables[2][1]]
+        counts = {}
+        with app.app_context():
+            for table_name, records in tables:
+                with Timer() as t:
+                    for i in range(0, len(records), 1000):
+                        query.Post(query={'table_name': table_name, 'data': validated(table_name, records[i:i + 1000])})
+                counts[table_name] = {'records': len(records), 'load_seconds': round(t.elapsed, 3)}
+                print('Loaded {:>7} {:<12} in {:.1f}s'.format(len(records), table_name, t.elapsed))
+        return counts
+
+    def business_id(self):
+        return random.choice(self.skewed_business_ids)
+
+    def get_payload(self, schema):
+        params = {'business_id': self.business_id()}
+        if schema == 'top_tokens':
+            params['k'] = 25
+        elif schema == 'search_reviews':
+            params = {'query': ' '.join(random.sample(WORDS, 2)), 'limit': 20}
+            if random.random() < 0.5:
+                params['business_id'] = self.business_id()
+        return {'schema': schema, 'params': params}
+
+    def post_payload(self, table_name, size):
+        if table_name == 'review_sentiment':
+            ids = random.sample(self.review_ids, size)
+            records = make_records(table_name, size, self.business_ids, self.user_ids, ids=ids)
+        else:
+            records = make_records(table_name, size, self.skewed_business_ids, self.skewed_user_ids)
+        return {'table_name': table_name, 'data': records}
+
+
+###Driver###
+def drive(app, dataset, mix, args):
+    """Run args.requests operations from args.clients threads.  Returns {operation: [(seconds, status)]}."""
+    operations = random.choices(list(mix), weights=list(mix.values()), k=args.requests)
+    samples = defaultdict(list)
+    lock = threading.Lock()
+    clients = threading.local()
+
+    def run(name):
+        if not hasattr(clients, 'client'):
+            clients.client = app.test_client()
+        if name in GET_SCHEMAS:
+            method, payload = 'GET', dataset.get_payload(name)
+        else:
+            method, payload = 'POST', dataset.post_payload(name, args.post_batch)
+        start = time.perf_counter()
+        response = clients.client.open('/api/data', method=method, json=payload)
+        elapsed = time.perf_counter() - start
+        with lock:
+            samples['{} {}'.format(method, name)].append((elapsed, response.status_code))
+
+    with Timer() as total:
+        with ThreadPoolExecutor(max_workers=args.clients) as executor:
+            list(executor.map(run, operations))
+    return samples, total.elapsed
+
+
+def percentile(sorted_values, p):
+    # Nearest rank
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed):
+    results = {}
+    for operation, values in sorted(samples.items()):
+        latencies = sorted(seconds * 1e3 for seconds, status in values)
+        statuses = Counter(str(status) for seconds, status in values)
+        results[operation] = {
+            'count': len(values),
+            # Tail businesses can have no reviews yet: 404 is an answer, not an error
+            'errors': sum(n for status, n in statuses.items() if status not in ('200', '404')),
+            'statuses': dict(statuses),
+            'throughput': round(len(values) / elapsed, 2),
+            'mean_ms': round(sum(latencies) / len(latencies), 3),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+        }
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, elapsed, requests):
+    print('\n{} requests in {:.2f}s ({:.1f} req/s)'.format(requests, elapsed, requests / elapsed))
+    print('{:<26}{:>7}{:>7}{:>9}{:>10}{:>10}{:>10}'.format('operation', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for operation, r in results.items():
+        print('{:<26}{:>7}{:>7}{:>9.1f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+            operation, r['count'], r['errors'], r['throughput'], r['p50_ms'], r['p95_ms'], r['p99_ms']))
+
+
+def print_comparison(results, previous):
+    print('\nChange vs {} (commit {})'.format(previous['meta']['timestamp'], previous['meta']['git_commit']))
+    print('{:<26}{:>12}{:>12}{:>12}'.format('operation', 'req/s', 'p50', 'p95'))
+    for operation, r in results.items():
+        before = previous['results'].get(operation)
+        if before is None:
+            continue
+
+        def change(key):
+            return '{:+.1f}%'.format((r[key] - before[key]) / before[key] * 100) if before[key] else 'n/a'
+        print('{:<26}{:>12}{:>12}{:>12}'.format(operation, change('throughput'), change('p50_ms'), change('p95_ms')))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    mix = parse_mix(args.mix)
+    config = {'CACHE_SCHEMA_TIMEOUTS': {}} if args.no_cache else {}
+    app = make_app(**config)
+    dataset = Dataset(args)
+    counts = dataset.load(app)
+    samples, elapsed = drive(app, dataset, mix, args)
+    results = summarize(samples, elapsed)
+    print_results(results, elapsed, args.requests)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat(timespec='seconds'),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'args': vars(args),
+        },
+        'dataset': counts,
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput': round(args.requests / elapsed, 2),
+        'results': results,
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('\nResults written to {}'.format(args.output))
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Columnar Responses
+    Arrow IPC stream and Parquet bodies for GET schemas (params: format='arrow'|'parquet').
+    Rows are converted chunk by chunk straight from the query result and written out as
+    record batches / row groups while the query is still being read.
+
+    pyarrow is optional.  JSON responses work without it.
+"""
+import io
+from datetime import datetime
+
+from flask import Response, stream_with_context
+
+from errors import InvalidUsage
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+MIMETYPES = {
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def check_format(fmt):
+    if fmt not in MIMETYPES:
+        raise InvalidUsage(message='format must be one of json, {}'.format(', '.join(MIMETYPES)))
+    if pa is None:
+        raise InvalidUsage(message='Columnar formats need pyarrow installed on the server', status_code=501)
+
+
+class Sink(io.RawIOBase):
+    """Write-only file object whose contents are drained after every batch."""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def arrow_type(column):
+    # SQLAlchemy column -> Arrow type
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return pa.timestamp('us')
+    return {float: pa.float64(), int: pa.int64()}.get(python_type, pa.string())
+
+
+def stream_rows(fmt, columns, row_chunks):
+    """Response streaming row_chunks (lists of row tuples ordered like columns) as fmt."""
+    check_format(fmt)
+    schema = pa.schema([(column.name, arrow_type(column)) for column in columns])
+
+    def generate():
+        sink = Sink()
+        if fmt == 'arrow':
+            writer = pa.RecordBatchStreamWriter(sink, schema)
+        else:
+            writer = pq.ParquetWriter(sink, schema)
+        for rows in row_chunks:
+            arrays = [pa.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)]
+            batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+            if fmt == 'arrow':
+                writer.write_batch(batch)
+            else:
+                writer.write_table(pa.Table.from_batches([batch]))
+            yield sink.drain()
+        writer.close()
+        yield sink.drain()
+
+    return Response(stream_with_context(generate()), mimetype=MIMETYPES[fmt])
+
+
+def table_response(fmt, records):
+    """Response holding records (list of dicts with the same keys) as a single table."""
+    check_format(fmt)
+    columns = list(records[0].keys()) if records else []
+    table = pa.Table.from_pydict({key: [record[key] for record in records] for key in columns})
+    sink = Sink()
+    if fmt == 'arrow':
+        writer = pa.RecordBatchStreamWriter(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+    else:
+        pq.write_table(table, sink)
+    return Response(sink.drain(), mimetype=MIMETYPES[fmt])
@@ -0,0 +1,162 @@
+"""
+Compression
+    Compressed request and response bodies.
+
+    Requests: a body sent with Content-Encoding: gzip (or zstd, when zstandard is installed)
+    is inflated before the route reads it, up to MAX_DECOMPRESSED_BYTES.  NDJSON uploads to
+    /api/data/stream are inflated incrementally by ingest.iter_ndjson instead.
+    Responses: JSON, NDJSON and Arrow bodies of at least COMPRESS_MIN_BYTES are compressed
+    with the best encoding the client accepts (zstd, then gzip).  Streamed responses are
+    compressed chunk by chunk.
+"""
+import logging
+import zlib
+from io import BytesIO
+
+from flask import current_app, request
+from werkzeug.http import parse_accept_header
+
+import metrics
+from errors import InvalidUsage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+compression_logger = logging.getLogger(__name__)
+
+# Preferred first
+ENCODINGS = ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+DECODE_ERRORS = (zlib.error, zstandard.ZstdError) if zstandard is not None else (zlib.error,)
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'application/vnd.apache.arrow.stream', 'text/plain')
+STREAMED_ENDPOINTS = ('data_stream',)  # Routes that inflate their own body as it arrives
+
+
+###Decoding###
+def check_encoding(content_encoding):
+    """Normalized Content-Encoding, or None for an uncompressed body"""
+    content_encoding = (content_encoding or '').strip().lower()
+    if content_encoding in ('', 'identity'):
+        return None
+    if content_encoding not in ENCODINGS:
+        raise InvalidUsage(message='Unsupported Content-Encoding {}.  Supported: {}'.format(
+            content_encoding, ', '.join(ENCODINGS)), status_code=415)
+    return content_encoding
+
+
+def decompressor(content_encoding):
+    """Incremental decoder with decompress(chunk) and flush(), or None for identity"""
+    content_encoding = check_encoding(content_encoding)
+    if content_encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if content_encoding == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def decompress(data, content_encoding, limit):
+    """Inflate a whole body.  Raises 413 past limit bytes and 400 for a corrupt body."""
+    content_encoding = check_encoding(content_encoding)
+    if content_encoding is None:
+        return data
+    try:
+        if content_encoding == 'gzip':
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            body = decoder.decompress(data, limit + 1)
+            complete = decoder.eof
+        else:
+            with zstandard.ZstdDecompressor().stream_reader(BytesIO(data)) as reader:
+                body = reader.read(limit + 1)
+            complete = True
+    except DECODE_ERRORS:
+        raise InvalidUsage(message='Request body is not valid {}'.format(content_encoding))
+    if len(body) > limit:
+        raise InvalidUsage(message='Decompressed request body exceeds {} bytes'.format(limit), status_code=413)
+    if not complete:
+        raise InvalidUsage(message='Request body ends before the end of the {} stream'.format(content_encoding))
+    return body
+
+
+def before_request():
+    # Swap the compressed input for the inflated body before anything reads it
+    environ = request.environ
+    content_encoding = environ.get('HTTP_CONTENT_ENCODING')
+    if not content_encoding or request.endpoint in STREAMED_ENDPOINTS:
+        return
+    body = decompress(request.stream.read(), content_encoding, current_app.config['MAX_DECOMPRESSED_BYTES'])
+    # request.stream and content_length are cached on first access.  Reset them with the environ.
+    environ['wsgi.input'] = BytesIO(body)
+    environ['CONTENT_LENGTH'] = str(len(body))
+    del environ['HTTP_CONTENT_ENCODING']
+    for attribute in ('stream', 'content_length'):
+        request.__dict__.pop(attribute, None)
+
+
+###Encoding###
+def negotiate(accept_encoding):
+    """Best encoding in ENCODINGS accepted by an Accept-Encoding header value, or None"""
+    if not accept_encoding:
+        return None
+    accepted = parse_accept_header(accept_encoding)
+    best = max(ENCODINGS, key=lambda encoding: accepted[encoding])
+    return best if accepted[best] > 0 else None
+
+
+def compressor(encoding, level):
+    """Incremental encoder with compress(chunk) and flush()"""
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level['zstd']).compressobj()
+    return zlib.compressobj(level['gzip'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def compress(data, encoding, level):
+    encoder = compressor(encoding, level)
+    return encoder.compress(data) + encoder.flush()
+
+
+def compress_chunks(chunks, encoder):
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = encoder.compress(chunk)
+        if data:
+            yield data
+    yield encoder.flush()
+
+
+def levels(config):
+    return {'gzip': config['COMPRESS_GZIP_LEVEL'], 'zstd': config['COMPRESS_ZSTD_LEVEL']}
+
+
+def compressible(response):
+    return response.status_code < 300 and response.mimetype in COMPRESSIBLE and \
+        'Content-Encoding' not in response.headers and not response.direct_passthrough
+
+
+def after_request(response):
+    config = current_app.config
+    if not config['COMPRESS_RESPONSES'] or not compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, compressor(encoding, levels(config)))
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < config['COMPRESS_MIN_BYTES']:
+            return response
+        with metrics.timed('serialize_seconds'):
+            response.set_data(compress(body, encoding, levels(config)))
+        compression_logger.debug('{} response: {} -> {} bytes'.format(encoding, len(body), response.content_length))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app):
+    app.before_request(before_request)
+    app.after_request(after_request)
@@ -2,63 +2,184 @@
 Database
     Initialize and create connection control flow for database.
     Datase parameters must be set in config.py or directly in app.py
+
+    One engine (and connection pool) is created per worker process and shared by every
+    request.  Pool settings come from app.config (DB_POOL_*).
+
+    GET schemas read through DATABASE_READ_URI (a replica) when it is set.  POSTs, tickets and
+    migrations always use DATABASE_URI.
 """
 
 
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
 from contextlib import contextmanager
+from urllib.parse import urlencode
 from models import *
+import metrics
 
 import click
-from flask import current_app, g
+from flask import current_app
 from flask.cli import with_appcontext
 
 import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+db_logger = logging.getLogger(__name__)
+
+# Process-wide engines keyed by database URI.  Rebuilt if the process forks (gunicorn workers).
+_engines = {}
+_engine_roles = {}  # URI -> 'write' or 'read'
+_engines_pid = None
+_engines_lock = threading.Lock()
+
+# Module-level session factory.  Sessions are bound to a pooled connection in get_session().
+Session = sessionmaker()
+
+# Pool checkout statistics for monitoring.  See pool_status().
+_pool_stats = {'checkouts': 0, 'timeouts': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+_pool_stats_lock = threading.Lock()
+
+
+def database_uri(config, role='write'):
+    """URI for role 'write' (DATABASE_URI) or 'read' (DATABASE_READ_URI, else DATABASE_URI)."""
+    if role == 'read' and config.get('DATABASE_READ_URI'):
+        return config['DATABASE_READ_URI']
+    return config['DATABASE_URI']
+
+
+def engine_options(config, uri):
+    """Build create_engine() keyword arguments from app config."""
+    url = make_url(uri)
+    options = {
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', -1),
+    }
+    if url.get_backend_name() == 'sqlite':
+        # Pooled connections are shared between threads
+        options['connect_args'] = {'check_same_thread': False}
+        if url.query.get('uri'):
+            options['creator'] = sqlite_uri_creator(url, options['connect_args'])
+        if url.database in (None, '', ':memory:'):
+            # Every checkout must see the same in-memory database
+            options['poolclass'] = StaticPool
+            return options
+        options['poolclass'] = QueuePool
+    options.update(
+        pool_size=config.get('DB_POOL_SIZE', 5),
+        max_overflow=config.get('DB_MAX_OVERFLOW', 10),
+        pool_timeout=config.get('DB_POOL_TIMEOUT', 30),
+    )
+    return options
+
+
+def sqlite_uri_creator(url, connect_args):
+    """Connection factory for sqlite:///file:...?mode=ro&uri=true URLs.
+    SQLAlchemy before 1.3.9 passes the URL's query to sqlite3.connect as keyword strings
+    (uri='true', mode='ro'), which fails.  Rebuild the file: URI and connect directly.
+    """
+    parameters = {key: value for key, value in url.query.items() if key != 'uri'}
+    database = url.database + ('?' + urlencode(parameters) if parameters else '')
+    return lambda: sqlite3.connect(database, uri=True, **connect_args)
 
 
-def get_db():
+def get_engine(config, role='write'):
+    """Return the engine for role's database URI, creating it once per process.
+    Without a separate read URI, reads share the write engine and its pool.
     """
-    Returns current database connection.  If connection not present,
-    initiates connection to configured database.  Default is non-authenticated SQL.
-    Modifty g.db = *connect to match intended database connection.
+    global _engines_pid
+    uri = database_uri(config, role)
+    if uri == config['DATABASE_URI']:
+        role = 'write'
+    with _engines_lock:
+        if _engines_pid != os.getpid():
+            # Pools must not be shared across fork.  Drop inherited engines.
+            for engine in _engines.values():
+                engine.dispose()
+            _engines.clear()
+            _engines_pid = os.getpid()
+        if uri not in _engines:
+            db_logger.info('Creating {} engine for {}.'.format(role, repr(make_url(uri))))
+            engine = create_engine(uri, **engine_options(config, uri))
+            metrics.instrument_engine(engine, role, slow_query_ms=config.get('DB_SLOW_QUERY_MS', 500))
+            _engines[uri] = engine
+            _engine_roles[uri] = role
+    return _engines[uri]
+
+
+def get_db(role='write'):
     """
-    db_logger = logging.getLogger(__name__ + '.getdb')
-    if 'db' not in g:
-        db_logger.info('DB connection not found. Attempting connection to {}.'.format(current_app.config['DATABASE_URI']))
-        try:
-            g.engine = create_engine(current_app.config['DATABASE_URI'])
-            g.db = g.engine.connect()
-        except:
-            db_logger.error('Could not establish connection.  Aborting.')
-            raise ConnectionError
+    Returns the process-wide engine for the configured database.  Default is non-authenticated SQL.
+    Connections are checked out of its pool by get_session().
+    param role: 'write' (DATABASE_URI) or 'read' (DATABASE_READ_URI when set)
+    """
+    return get_engine(current_app.config, role)
 
-    return g.db
+
+def connect(engine):
+    # Check a connection out of the pool and record how long the checkout waited
+    start = time.perf_counter()
+    try:
+        connection = engine.connect()
+    except PoolTimeoutError:
+        with _pool_stats_lock:
+            _pool_stats['timeouts'] += 1
+        db_logger.error('Timed out waiting for a pooled connection.')
+        raise
+    wait = time.perf_counter() - start
+    with _pool_stats_lock:
+        _pool_stats['checkouts'] += 1
+        _pool_stats['wait_total'] += wait
+        _pool_stats['wait_max'] = max(_pool_stats['wait_max'], wait)
+    return connection
 
 
 @contextmanager
-def get_session():
-    # Setup session with thread engine.
+def get_session(role='write'):
+    # Setup session on a pooled connection.
     #   Allows for usage: with get_session() as session: session...
-    engine = get_db()
-    session = scoped_session(sessionmaker(bind=engine))
+    #   GET schemas use get_session('read')
+    connection = connect(get_db(role))
+    session = Session(bind=connection)
     try:
         yield session
     finally:
         session.close()
-
-
-def close_db(e=None):
-    db = g.pop('db', None)
-    engine = g.pop('engine', None)
-    if db is not None:
-        db.close()
-        engine.dispose()
+        connection.close()  # Returns the connection to the pool
+
+
+def pool_status():
+    """Pool and checkout statistics for every engine in this process."""
+    with _pool_stats_lock:
+        status = dict(_pool_stats)
+    status['wait_mean'] = status['wait_total'] / status['checkouts'] if status['checkouts'] else 0.0
+    status['pid'] = os.getpid()
+    status['engines'] = {}
+    for uri, engine in list(_engines.items()):
+        pool = engine.pool
+        status['engines'][repr(make_url(uri))] = {
+            'role': _engine_roles.get(uri),
+            'pool': pool.__class__.__name__,
+            'size': pool.size() if hasattr(pool, 'size') else None,
+            'checked_in': pool.checkedin() if hasattr(pool, 'checkedin') else None,
+            'checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else None,
+            'overflow': pool.overflow() if hasattr(pool, 'overflow') else None,
+        }
+    return status
 
 
 def init_db():
+    import search
     db = get_db()
     Base.metadata.create_all(db)
+    search.install(db)  # Full-text index for search_reviews (not expressible in models.py)
 
 @click.command('init-db')
 @with_appcontext
@@ -68,6 +189,51 @@ def init_db_command():
     click.echo('Initialized the database')
 
 
+@click.command('migrate-viz2')
+@with_appcontext
+def migrate_viz2_command():
+    """Convert legacy string-encoded viz2 fields to JSON"""
+    import viz2
+    count = viz2.migrate(get_db())
+    click.echo('Migrated {} viz2 rows'.format(count))
+
+
+@click.command('migrate-indexes')
+@click.option('--report', is_flag=True, help='Time hot queries before and after')
+@with_appcontext
+def migrate_indexes_command(report):
+    """Build indexes declared in models.py on an existing database"""
+    import indexes
+    if not report:
+        created = indexes.migrate_indexes(get_db())
+    else:
+        created, timings = indexes.migrate_with_report(get_db())
+        click.echo('{:<20}{:>12}{:>12}'.format('query', 'before ms', 'after ms'))
+        for name, (before, after) in timings.items():
+            click.echo('{:<20}{:>12.2f}{:>12.2f}'.format(name, before, after))
+    click.echo('Created {} indexes: {}'.format(len(created), ', '.join(created) or 'none'))
+
+
+@click.command('rebuild-aggregates')
+@with_appcontext
+def rebuild_aggregates_command():
+    """Recompute per-business review aggregates and token postings from the reviews table"""
+    import aggregates
+    for table, rows in aggregates.rebuild(get_db()).items():
+        click.echo('{}: {} rows'.format(table, rows))
+
+
+@click.command('rebuild-search')
+@with_appcontext
+def rebuild_search_command():
+    """Build the full-text index for search_reviews and fill it from reviews"""
+    import search
+    click.echo('Indexed {} reviews'.format(search.rebuild(get_db())))
+
+
 def init_app(app):
-    app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_viz2_command)
+    app.cli.add_command(migrate_indexes_command)
+    app.cli.add_command(rebuild_aggregates_command)
+    app.cli.add_command(rebuild_search_command)
@@ -0,0 +1,102 @@
+"""
+Batch Fingerprints
+    Idempotent POST.  A client may send 'fingerprint' (a hash of the package, see
+    write_on_job.batch_fingerprint) with a POST.  The writer stores the fingerprints of the
+    batches it commits in applied_batches, in the same transaction as their records.  A
+    retried package whose fingerprint is stored is acknowledged straight away without
+    validation or any table access beyond one primary key lookup.
+
+    The table is bounded: FINGERPRINT_MAX_ROWS newest fingerprints are kept (0 turns
+    fingerprinting off).  A retry arriving after its fingerprint was pruned is applied again,
+    which the upserts make safe.
+"""
+import itertools
+import logging
+import re
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import select
+
+from db import get_session
+from errors import InvalidUsage
+from models import AppliedBatch
+from upsert import chunks
+
+
+fingerprint_logger = logging.getLogger(__name__)
+
+FINGERPRINT = re.compile(r'^[\w\-+/=:.]{16,128}$')
+PRUNE_EVERY = 100  # Recorded batches between pruning passes, per worker process
+
+_recorded = itertools.count(1)
+
+
+def enabled():
+    return current_app.config['FINGERPRINT_MAX_ROWS'] > 0
+
+
+def parse(query):
+    """The package's fingerprint, or None if it has none or fingerprinting is off."""
+    fingerprint = query.get('fingerprint')
+    if fingerprint is None or not enabled():
+        return None
+    if type(fingerprint) != str or not FINGERPRINT.match(fingerprint):
+        raise InvalidUsage(message='fingerprint must be a string of 16 to 128 hash characters')
+    return fingerprint
+
+
+def lookup(session, fingerprints):
+    """{fingerprint: records committed} for the fingerprints already stored"""
+    applied = {}
+    for chunk in chunks(set(fingerprints)):
+        rows = session.query(AppliedBatch.fingerprint, AppliedBatch.record_count).\
+            filter(AppliedBatch.fingerprint.in_(chunk))
+        applied.update(rows)
+    return applied
+
+
+def stored(fingerprints):
+    # Writer entry point.  Reads the write database: a replica may not have the fingerprints yet.
+    with get_session() as session:
+        return lookup(session, fingerprints)
+
+
+def find_applied(query):
+    """Acknowledgement for a package already committed, else None."""
+    fingerprint = parse(query)
+    if fingerprint is None:
+        return None
+    applied = stored([fingerprint])
+    if fingerprint not in applied:
+        return None
+    fingerprint_logger.info('Batch {} already applied.  Acknowledging duplicate.'.format(fingerprint))
+    return acknowledgement(applied[fingerprint])
+
+
+def acknowledgement(applied):
+    return {'message': 'POST already applied', 'applied': applied, 'duplicate': True}
+
+
+def record(session, table_name, batches):
+    """Store (fingerprint, records committed) pairs.  Call inside the batch's transaction."""
+    if not batches:
+        return
+    now = datetime.utcnow()
+    session.execute(AppliedBatch.__table__.insert(), [
+        {'fingerprint': fingerprint, 'table_name': table_name, 'record_count': count, 'applied_at': now}
+        for fingerprint, count in batches])
+    if next(_recorded) % PRUNE_EVERY == 0:
+        prune(session, current_app.config['FINGERPRINT_MAX_ROWS'])
+
+
+def prune(session, max_rows):
+    """Delete all but the max_rows newest fingerprints."""
+    table = AppliedBatch.__table__
+    cutoff = session.execute(
+        select([table.c.applied_at]).order_by(table.c.applied_at.desc()).offset(max_rows).limit(1)).scalar()
+    if cutoff is None:
+        return 0
+    deleted = session.execute(table.delete().where(table.c.applied_at <= cutoff)).rowcount
+    fingerprint_logger.info('Pruned {} applied batch fingerprints'.format(deleted))
+    return deleted
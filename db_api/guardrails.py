@@ -0,0 +1,144 @@
+"""
+Query Guardrails
+    Per-schema limits for JSON GETs, so a few pathological requests (biz_words for the most
+    reviewed businesses, batches of thousands of business_ids) cannot pin a worker and the
+    database.
+
+    QUERY_MAX_ROWS: rows a schema may return.  Requests are costed before they run (review
+    counts come from the aggregate tables) and refused with 413 when over the limit.  The
+    fetch is also capped, so a stale estimate cannot let an oversized result through.
+    QUERY_TIMEOUT_MS: statement timeout for the request's queries.  PostgreSQL enforces it
+    with SET LOCAL statement_timeout, SQLite with a progress handler.  A query past its
+    timeout is cancelled and answered with 504.
+
+    Streamed and Arrow/Parquet responses have no row limit (they hold one chunk in memory at
+    a time) but their queries are cancelled after STREAM_TIMEOUT_MS.  The response has already
+    started by then, so the client sees a truncated body rather than a 504.
+"""
+import logging
+import time
+from contextlib import contextmanager
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+import metrics
+from errors import InvalidUsage
+
+
+guardrail_logger = logging.getLogger(__name__)
+
+PROGRESS_STEPS = 1000  # SQLite VM instructions between timeout checks
+HINTS = {
+    'biz_words': 'Page with limit and after_date, or request stream: true.',
+    'biz_comp': 'Request fewer business_ids.',
+    'biz_stats': 'Request fewer business_ids.',
+}
+
+
+def max_rows(schema):
+    # 0 or missing means no limit
+    return current_app.config['QUERY_MAX_ROWS'].get(schema, 0)
+
+
+def timeout_ms(schema):
+    return current_app.config['QUERY_TIMEOUT_MS'].get(schema, 0)
+
+
+def reject(schema, reason, error):
+    metrics.guardrail_rejections.inc(1, schema, reason)
+    guardrail_logger.warning('{} refused: {}'.format(schema, error.message))
+    return error
+
+
+def too_many_rows(schema, rows, limit):
+    """Error for a request over its row limit.  rows: the estimate, None when only the
+    capped fetch found the excess.
+    """
+    count = rows if rows is not None else 'more than {}'.format(limit)
+    return reject(schema, 'rows', InvalidUsage(
+        message='{} would return {} rows.  The limit is {}.  {}'.format(schema, count, limit, HINTS.get(schema, '')).strip(),
+        status_code=413, payload={'rows': rows, 'max_rows': limit}))
+
+
+def check_rows(schema, estimator, session, params):
+    """Refuse the request if estimator(session, params) is over the schema's row limit."""
+    limit = max_rows(schema)
+    if not limit or estimator is None:
+        return
+    if type(params.get('limit')) == int and params['limit'] <= limit:
+        # A page within the limit cannot exceed it.  Skips counting what is left after a cursor.
+        return
+    rows = estimator(session, params)
+    if rows > limit:
+        raise too_many_rows(schema, rows, limit)
+
+
+def cap(schema, response, limit=None):
+    """Limit a row query to one row past the schema's limit, so fetching it shows whether
+    the limit was crossed.  Queries with their own smaller limit are left alone.
+    """
+    most = max_rows(schema)
+    if not most or (limit is not None and limit <= most):
+        return response
+    return response.limit(most + 1)
+
+
+def check_fetched(schema, rows):
+    most = max_rows(schema)
+    if most and rows > most:
+        raise too_many_rows(schema, None, most)
+
+
+def stream_timeout(session, schema):
+    """statement_timeout for streamed and Arrow/Parquet responses"""
+    return statement_timeout(session, schema, current_app.config['STREAM_TIMEOUT_MS'], streamed=True)
+
+
+@contextmanager
+def statement_timeout(session, schema, timeout=None, streamed=False):
+    """Cancel the session's statements that run past timeout ms, by default the schema's
+    QUERY_TIMEOUT_MS (504).
+    """
+    if timeout is None:
+        timeout = timeout_ms(schema)
+    if not timeout:
+        yield
+        return
+    connection = session.connection()
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        # Lasts until the end of the request's transaction
+        connection.execute(text('SET LOCAL statement_timeout = {:d}'.format(timeout)))
+        try:
+            yield
+        except OperationalError as e:
+            if getattr(e.orig, 'pgcode', None) != '57014':  # query_canceled
+                raise
+            raise timed_out(schema, timeout, streamed)
+    elif dialect == 'sqlite':
+        dbapi_connection = connection.connection
+        deadline = time.perf_counter() + timeout / 1e3
+        # A truthy return interrupts the running statement
+        dbapi_connection.set_progress_handler(lambda: time.perf_counter() > deadline, PROGRESS_STEPS)
+        try:
+            yield
+        except OperationalError as e:
+            if 'interrupted' not in str(e.orig):
+                raise
+            raise timed_out(schema, timeout, streamed)
+        finally:
+            # The connection goes back to the pool
+            dbapi_connection.set_progress_handler(None, 0)
+    else:
+        guardrail_logger.debug('No statement timeout support for {}'.format(dialect))
+        yield
+
+
+def timed_out(schema, timeout, streamed=False):
+    # The hints point at streaming, so streamed responses get none
+    hint = '' if streamed else HINTS.get(schema, '')
+    return reject(schema, 'timeout', InvalidUsage(
+        message='{} query cancelled after {} ms.  {}'.format(schema, timeout, hint).strip(),
+        status_code=504, payload={'timeout_ms': timeout}))
@@ -0,0 +1,112 @@
+"""
+Index Migration
+    Builds the indexes declared in models.py on databases created before they existed
+    (create_all only creates missing tables, not missing indexes) and times the query.py
+    hot paths before and after.
+"""
+import logging
+import statistics
+import time
+
+from sqlalchemy import inspect, select, text
+from sqlalchemy.orm import Session
+
+from models import Base, Review, Tip, ReviewSentiment, TipSentiment, Viz2
+
+
+index_logger = logging.getLogger(__name__)
+
+# (table, old index, declared index that replaces it).  The old index is dropped once the
+# new one exists.
+SUPERSEDED = [
+    ('reviews', 'ix_reviews_business_id_date', 'ix_reviews_business_id_date_review_id'),
+]
+
+
+def missing_indexes(engine):
+    """Declared indexes not present in the database, for tables that exist."""
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in table.indexes if index.name not in existing)
+    return missing
+
+
+def migrate_indexes(engine):
+    """Create every missing declared index and drop the ones they supersede.
+    Returns the names created.
+    """
+    created = []
+    for index in missing_indexes(engine):
+        index_logger.info('Creating index {} on {}'.format(index.name, index.table.name))
+        index.create(bind=engine)
+        created.append(index.name)
+    drop_superseded(engine)
+    return created
+
+
+def drop_superseded(engine):
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table, old, new in SUPERSEDED:
+        if table not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table)}
+        if old in existing and new in existing:
+            index_logger.info('Dropping index {} on {} (replaced by {})'.format(old, table, new))
+            with engine.begin() as connection:
+                connection.execute(text('DROP INDEX {}'.format(old)))
+
+
+def hot_queries(connection):
+    """The filters and joins query.py runs, with sample keys taken from the data.
+    Each entry is a list of statements, timed together (biz_words reads one per phase).
+    """
+    import query
+
+    def sample(column):
+        return connection.execute(select([column]).where(column.isnot(None)).limit(1)).scalar()
+
+    session = Session(bind=connection)
+    business_id = sample(Review.business_id)
+    queries = {
+        'biz_words': [phase.statement for phase in
+                      query.biz_words_queries(session, {'business_id': business_id})],
+        'tips_by_business': [select([Tip.tip_id]).where(Tip.business_id == sample(Tip.business_id))],
+        'review_sentiment': [select([ReviewSentiment.rs_id]).
+            where(ReviewSentiment.review_id == sample(ReviewSentiment.review_id))],
+        'tip_sentiment': [select([TipSentiment.ts_id]).
+            where(TipSentiment.tip_id == sample(TipSentiment.tip_id))],
+        'viz2': [select([Viz2.vz_id]).where(Viz2.business_id == sample(Viz2.business_id))],
+    }
+    session.close()
+    return queries
+
+
+def time_queries(engine, queries, repeat=5):
+    """Median milliseconds per query"""
+    timings = {}
+    with engine.connect() as connection:
+        for name, statements in queries.items():
+            samples = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for statement in statements:
+                    connection.execute(statement).fetchall()
+                samples.append((time.perf_counter() - start) * 1e3)
+            timings[name] = statistics.median(samples)
+    return timings
+
+
+def migrate_with_report(engine, repeat=5):
+    """Create missing indexes and return (created, {query: (before ms, after ms)})."""
+    with engine.connect() as connection:
+        queries = hot_queries(connection)
+    before = time_queries(engine, queries, repeat)
+    created = migrate_indexes(engine)
+    after = time_queries(engine, queries, repeat)
+    return created, {name: (before[name], after[name]) for name in queries}
@@ -0,0 +1,221 @@
+"""
+Asynchronous Ingestion
+    POST packages sent with 'async': true are validated, stored as an ingestion ticket and
+    answered with 202 straight away.  A background worker pool hands the batch to the
+    write coordinator and records the outcome on the ticket.  Tickets live in the database so
+    any worker process can answer /api/ingest/<ticket_id>.
+
+    NDJSON uploads to /api/data/stream are parsed incrementally and written in fixed-size
+    sub-batches, so memory use does not grow with the size of the upload.
+"""
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import ujson
+from flask import current_app
+
+import compression
+import metrics
+from db import get_session
+from errors import InvalidUsage
+from models import IngestTicket
+from validators import validate_records, rejection_report, MAX_REPORTED_ERRORS
+from writer import get_coordinator
+
+
+ingest_logger = logging.getLogger(__name__)
+
+
+class IngestPool():
+    """Background workers that apply ticketed batches.
+
+    param app: Flask app.  Workers run inside its app context.
+    param workers: Number of batches in flight at once.
+    param max_pending: Queued batches allowed before new tickets are refused.
+    """
+    def __init__(self, app, workers=4, max_pending=200):
+        self.app = app
+        self.workers = workers
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pid = None
+        self.executor = None
+        self.pending = 0
+
+    def get_executor(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Executor threads do not survive fork
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ingest')
+                self.pid = os.getpid()
+        return self.executor
+
+    def reserve(self):
+        # Claim a queue slot before a ticket is created.  Refuse when the backlog is full.
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise InvalidUsage(message='Ingestion queue full.  Retry later.', status_code=503)
+            self.pending += 1
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+
+    def submit(self, ticket_id, table_name, records, rejected=0, fingerprint=None):
+        self.get_executor().submit(self.run, ticket_id, table_name, records, rejected, fingerprint)
+
+    def run(self, ticket_id, table_name, records, rejected=0, fingerprint=None):
+        # rejected: records already refused by validation and counted as failed on the ticket
+        with self.app.app_context():
+            try:
+                result = get_coordinator().submit(
+                    table_name=table_name, records=records, fingerprint=fingerprint).result()
+                update_ticket(ticket_id, status='applied', applied=result['applied'])
+            except Exception as e:
+                ingest_logger.error('Ticket {} failed: {}'.format(ticket_id, e))
+                update_ticket(ticket_id, status='failed', failed=len(records) + rejected, error=str(e))
+            finally:
+                self.release()
+
+    def status(self):
+        return {'workers': self.workers, 'pending': self.pending, 'max_pending': self.max_pending}
+
+
+def get_pool():
+    return current_app.extensions['ingest_pool']
+
+
+def submit_ticket(table_name, records, rejected=(), fingerprint=None):
+    """Create a ticket for validated records and queue them.  Returns the ticket.
+    rejected: validation failures (validators.validate_records), counted as failed straight away.
+    fingerprint: the package's fingerprint, stored by the writer with the records.
+    """
+    pool = get_pool()
+    pool.reserve()
+    now = datetime.utcnow()
+    ticket = IngestTicket(
+        ticket_id=uuid.uuid4().hex, table_name=table_name, status='queued',
+        received=len(records) + len(rejected), applied=0, failed=len(rejected),
+        error='{} records rejected by validation'.format(len(rejected)) if rejected else None,
+        created=now, updated=now)
+    try:
+        with get_session() as session:
+            session.add(ticket)
+            session.commit()
+            ticket = ticket_to_dict(ticket)
+    except Exception:
+        pool.release()
+        raise
+    pool.submit(ticket['ticket_id'], table_name, records, len(rejected), fingerprint)
+    ingest_logger.info('Ticket {} queued with {} records'.format(ticket['ticket_id'], ticket['received']))
+    if rejected:
+        ticket.update(rejection_report(rejected))
+    return ticket
+
+
+def update_ticket(ticket_id, **fields):
+    fields['updated'] = datetime.utcnow()
+    with get_session() as session:
+        session.query(IngestTicket).filter_by(ticket_id=ticket_id).update(fields)
+        session.commit()
+
+
+def get_ticket(ticket_id):
+    with get_session() as session:
+        ticket = session.query(IngestTicket).filter_by(ticket_id=ticket_id).scalar()
+        if ticket is None:
+            raise InvalidUsage(message='Ticket {} not found'.format(ticket_id), status_code=404)
+        return ticket_to_dict(ticket)
+
+
+def ticket_to_dict(ticket):
+    return {column.name: getattr(ticket, column.name) for column in IngestTicket.__table__.columns}
+
+
+def iter_ndjson(stream, content_encoding=None, chunk_size=64 * 1024):
+    """Yield records from a newline-delimited JSON stream without reading it all into memory.
+
+    param stream: File-like object (request.stream)
+    param content_encoding: None/'identity', 'gzip' or 'zstd' (compression.ENCODINGS)
+    """
+    decompressor = compression.decompressor(content_encoding)
+
+    buffer = b''
+    line_number = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if decompressor is not None:
+            try:
+                chunk = decompressor.decompress(chunk)
+            except compression.DECODE_ERRORS:
+                raise InvalidUsage(message='Request body is not valid {}'.format(content_encoding))
+        lines = (buffer + chunk).split(b'\n')
+        buffer = lines.pop()  # Last piece may be an incomplete line
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield parse_ndjson_line(line, line_number)
+    if decompressor is not None:
+        buffer += decompressor.flush()
+    if buffer.strip():
+        yield parse_ndjson_line(buffer, line_number + 1)
+
+
+def parse_ndjson_line(line, line_number):
+    try:
+        record = ujson.loads(line)
+    except ValueError:
+        raise InvalidUsage(message='Line {} is not valid JSON'.format(line_number))
+    if type(record) != dict:
+        raise InvalidUsage(message='Line {} is not a JSON object'.format(line_number))
+    return record
+
+
+def stream_ingest(stream, table_name, content_encoding=None, batch_size=500):
+    """Write an NDJSON upload to table_name in sub-batches of batch_size records.
+    Each sub-batch is committed before more of the body is read.
+    """
+    coordinator = get_coordinator()
+    committed = 0
+    batches = 0
+    rejected = {'count': 0, 'errors': []}  # Errors kept for the first MAX_REPORTED_ERRORS only
+
+    def flush(batch):
+        # Valid records are committed.  Rejected ones are reported by line (0-based record index).
+        records, batch_rejected = validate_records(table_name, batch)
+        offset = committed + rejected['count']  # Records read before this batch
+        rejected['count'] += len(batch_rejected)
+        for item in batch_rejected[:MAX_REPORTED_ERRORS - len(rejected['errors'])]:
+            rejected['errors'].append(dict(item, index=item['index'] + offset))
+        if records:
+            future = coordinator.submit(table_name=table_name, records=records)
+            with metrics.timed('db_seconds'):
+                future.result(timeout=current_app.config['WRITE_TIMEOUT'])
+        return len(records)
+
+    batch = []
+    try:
+        for record in iter_ndjson(stream, content_encoding):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                committed, batches, batch = committed + flush(batch), batches + 1, []
+        if batch:
+            committed, batches = committed + flush(batch), batches + 1
+    except InvalidUsage as e:
+        # Sub-batches before the bad line are already committed.  Say how far we got.
+        e.payload = {'records_committed': committed}
+        raise
+    ingest_logger.info('Streamed {} records into {} in {} batches'.format(committed, table_name, batches))
+    return {'message': 'Stream received and executed', 'records': committed, 'batches': batches,
+            'rejected': rejected['count'], 'errors': rejected['errors']}
+
+
+def init_app(app):
+    app.extensions['ingest_pool'] = IngestPool(
+        app, workers=app.config['INGEST_WORKERS'], max_pending=app.config['INGEST_MAX_PENDING'])
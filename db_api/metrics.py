@@ -0,0 +1,252 @@
+"""
+Metrics
+    In-process request instrumentation exposed in Prometheus text format at /metrics.
+
+    Each request records its schema (GET) or table (POST), rows in and out, SQL statement
+    count, time spent in the database, time spent serializing and total latency.  SQL is
+    counted with engine cursor events against a per-thread collector, so the group-commit
+    writer threads record their own db_api_write_* series.  Metrics are per worker process.
+"""
+import bisect
+import logging
+import threading
+import time
+
+from flask import request
+from sqlalchemy import event
+
+
+metrics_logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+class Histogram():
+    def __init__(self, name, description, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.setdefault(label_values, [0] * len(self.buckets) + [0.0, 0])
+            bucket = bisect.bisect_left(self.buckets, value)
+            if bucket < len(self.buckets):
+                series[bucket] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            for label_values, series in sorted(self.series.items()):
+                labels = format_labels(self.labels, label_values)
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append('{}_bucket{{{}}} {}'.format(self.name, join_labels(labels, 'le="{}"'.format(bound)), cumulative))
+                lines.append('{}_bucket{{{}}} {}'.format(self.name, join_labels(labels, 'le="+Inf"'), series[-1]))
+                lines.append('{}_sum{{{}}} {}'.format(self.name, labels, series[-2]))
+                lines.append('{}_count{{{}}} {}'.format(self.name, labels, series[-1]))
+        return lines
+
+
+class Counter():
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def inc(self, value, *label_values):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} counter'.format(self.name)]
+        with self.lock:
+            for label_values, value in sorted(self.series.items()):
+                lines.append('{}{{{}}} {}'.format(self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+
+def escape(value):
+    # Label value escapes of the Prometheus text format
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    return ','.join('{}="{}"'.format(name, escape(value)) for name, value in zip(names, values))
+
+
+def join_labels(*labels):
+    return ','.join(label for label in labels if label)
+
+
+REQUEST_LABELS = ('method', 'schema')
+request_seconds = Histogram('db_api_request_seconds', 'Total request latency', REQUEST_LABELS)
+request_db_seconds = Histogram('db_api_request_db_seconds', 'Time spent in the database (POST: waiting for commit)', REQUEST_LABELS)
+request_serialize_seconds = Histogram('db_api_request_serialize_seconds', 'Time spent encoding the response', REQUEST_LABELS)
+request_statements = Histogram('db_api_request_statements', 'SQL statements per request', REQUEST_LABELS, COUNT_BUCKETS)
+rows_in = Counter('db_api_rows_in_total', 'Records received by POST', REQUEST_LABELS)
+rows_out = Counter('db_api_rows_out_total', 'Rows returned by GET', REQUEST_LABELS)
+write_seconds = Histogram('db_api_write_seconds', 'Group commit duration per table', ('table',))
+write_statements = Histogram('db_api_write_statements', 'SQL statements per group commit', ('table',), COUNT_BUCKETS)
+write_records = Histogram('db_api_write_records', 'Records per group commit', ('table',), COUNT_BUCKETS)
+query_seconds = Histogram('db_api_query_seconds', 'SQL statement latency per engine', ('engine',))
+guardrail_rejections = Counter('db_api_guardrail_rejections_total', 'GETs refused by a row limit or statement timeout',
+                               ('schema', 'reason'))
+
+REGISTRY = [request_seconds, request_db_seconds, request_serialize_seconds, request_statements,
+            rows_in, rows_out, write_seconds, write_statements, write_records, query_seconds,
+            guardrail_rejections]
+
+
+###Collectors###
+_local = threading.local()
+SCHEMAS = set()  # Schema and table names used as labels.  Anything else a client sends is 'unknown'.
+UNKNOWN = 'unknown'
+
+
+class Collector():
+    """Statement count and timings for the work running on one thread."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.schema = None
+
+
+def current():
+    return getattr(_local, 'collector', None)
+
+
+def begin():
+    _local.collector = Collector()
+    return _local.collector
+
+
+def end():
+    collector, _local.collector = current(), None
+    return collector
+
+
+class timed():
+    """Add the duration of a block to an attribute of the current collector."""
+    def __init__(self, attribute):
+        self.attribute = attribute
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        collector = current()
+        if collector is not None:
+            setattr(collector, self.attribute, getattr(collector, self.attribute) + time.perf_counter() - self.start)
+
+
+def register_schemas(names):
+    SCHEMAS.update(names)
+
+
+def label(schema, rows_in=0):
+    # schema comes from the request body: only registered names become series
+    collector = current()
+    if collector is not None:
+        known = isinstance(schema, str) and schema in SCHEMAS
+        collector.schema, collector.rows_in = schema if known else UNKNOWN, rows_in
+
+
+def count_rows(response):
+    """Rows in a GET response: list lengths for 'data', one per business for batch maps."""
+    data = response.get('data', response) if isinstance(response, dict) else response
+    if isinstance(data, list):
+        return len(data)
+    if isinstance(data, dict) and 'data' in response:
+        return sum(len(v) if isinstance(v, list) else int(v is not None) for v in data.values())
+    return 1
+
+
+def record_rows_out(response):
+    collector = current()
+    if collector is not None:
+        collector.rows_out = count_rows(response)
+
+
+###Engine Instrumentation###
+def instrument_engine(engine, role='write', slow_query_ms=500):
+    """Count statements and record latency per engine role.  Slow statements are logged."""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        query_seconds.observe(elapsed, role)
+        if elapsed * 1e3 >= slow_query_ms:
+            metrics_logger.warning('Slow query on {} engine ({:.0f} ms): {}'.format(
+                role, elapsed * 1e3, ' '.join(statement.split())[:200]))
+        else:
+            metrics_logger.debug('{} engine query {:.2f} ms'.format(role, elapsed * 1e3))
+        collector = current()
+        if collector is not None:
+            collector.statements += 1
+            collector.db_seconds += elapsed
+
+
+###Flask Hooks###
+def before_request():
+    begin()
+
+
+def after_request(response):
+    collector = end()
+    if collector is not None:
+        record_request(request.method, collector, request.endpoint)
+    return response
+
+
+def record_request(method, collector, endpoint=None):
+    labels = (method, collector.schema or endpoint)
+    request_seconds.observe(time.perf_counter() - collector.start, *labels)
+    request_db_seconds.observe(collector.db_seconds, *labels)
+    request_serialize_seconds.observe(collector.serialize_seconds, *labels)
+    request_statements.observe(collector.statements, *labels)
+    if collector.rows_in:
+        rows_in.inc(collector.rows_in, *labels)
+    if collector.rows_out:
+        rows_out.inc(collector.rows_out, *labels)
+
+
+def record_write(table_name, collector, records):
+    # Called by the writer thread after each group commit attempt
+    write_seconds.observe(time.perf_counter() - collector.start, table_name)
+    write_statements.observe(collector.statements, table_name)
+    write_records.observe(records, table_name)
+
+
+def render(gauges=None):
+    """Prometheus text exposition.  gauges: {name: (description, {label string: value})}"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for name, (description, values) in (gauges or {}).items():
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} gauge'.format(name))
+        for labels, value in values.items():
+            lines.append('{}{} {}'.format(name, '{' + labels + '}' if labels else '', value))
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    app.before_request(before_request)
+    app.after_request(after_request)
@@ -9,7 +9,7 @@ from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 
 from sqlalchemy import \
-    (Column, Integer, String, ForeignKey, DateTime, Float, Binary, Text)
+    (Column, Integer, String, ForeignKey, DateTime, Float, Binary, Text, JSON, Index)
 from sqlalchemy.orm import relationship
 
 ###Data Models###
@@ -89,12 +89,17 @@ class Tip(Base):
     ngram = Column(Text)
     noun_chunk = Column(Text)
     lemma = Column(Text)
-    business_id = Column(String, ForeignKey('businesses.business_id'))
+    business_id = Column(String, ForeignKey('businesses.business_id'), index=True)
     user_id = Column(String, ForeignKey('users.user_id'))
 
 
 class Review(Base):
     __tablename__ = 'reviews'
+    __table_args__ = (
+        # biz_words: filter on business_id, order by (date, review_id) for the keyset cursor.
+        # Also serves business_id lookups.  Replaces ix_reviews_business_id_date (indexes.py).
+        Index('ix_reviews_business_id_date_review_id', 'business_id', 'date', 'review_id'),
+    )
 
     review_id = Column(String, primary_key=True)
     date = Column(DateTime)
@@ -116,7 +121,7 @@ class ReviewSentiment(Base):
     __tablename__ = 'review_sentiment'
 
     rs_id = Column(Integer, primary_key=True)
-    review_id = Column(String, ForeignKey('reviews.review_id'))
+    review_id = Column(String, ForeignKey('reviews.review_id'), index=True)
     polarity = Column(Float)
     subjectivity = Column(Float)
 
@@ -125,7 +130,7 @@ class TipSentiment(Base):
     __tablename__ = 'tip_sentiment'
 
     ts_id = Column(Integer, primary_key=True)
-    tip_id = Column(String, ForeignKey('tips.tip_id'))
+    tip_id = Column(String, ForeignKey('tips.tip_id'), index=True)
     polarity = Column(Float)
     subjectivity = Column(Float)
 
@@ -134,12 +139,72 @@ class Viz2(Base):
     __tablename__ = 'viz2'
 
     vz_id = Column(Integer, primary_key=True)
-    business_id = Column(String, ForeignKey('businesses.business_id'))
+    business_id = Column(String, ForeignKey('businesses.business_id'), index=True)
     categories = Column(String)
     percentile = Column(Float)
-    competitors = Column(Text)
-    bestinsector = Column(Text)
-    avg_stars_over_time = Column(Text)
-    chunk_sentiment = Column(Text)
-    count_by_star = Column(Text)
-    review_by_year = Column(Text)
\ No newline at end of file
+    # Parsed at write time, see viz2.py for shapes
+    competitors = Column(JSON)
+    bestinsector = Column(JSON)
+    avg_stars_over_time = Column(JSON)
+    chunk_sentiment = Column(JSON)
+    count_by_star = Column(JSON)
+    review_by_year = Column(JSON)
+
+###Aggregate Models###
+# Per-business review aggregates kept current by the review upsert (see aggregates.py)
+class BusinessReviewStats(Base):
+    __tablename__ = 'business_review_stats'
+
+    business_id = Column(String, primary_key=True)
+    review_count = Column(Integer)
+    rated_count = Column(Integer)  # Reviews with stars
+    stars_sum = Column(Float)  # average stars = stars_sum / rated_count
+
+
+class BusinessReviewYear(Base):
+    __tablename__ = 'business_review_years'
+
+    business_id = Column(String, primary_key=True)
+    year = Column(Integer, primary_key=True)
+    review_count = Column(Integer)
+
+
+class BusinessStarCount(Base):
+    __tablename__ = 'business_star_counts'
+
+    business_id = Column(String, primary_key=True)
+    stars = Column(Integer, primary_key=True)  # Review stars rounded to a whole star
+    review_count = Column(Integer)
+
+
+class TokenPosting(Base):
+    __tablename__ = 'token_postings'
+
+    business_id = Column(String, primary_key=True)
+    period = Column(String, primary_key=True)  # Review month, YYYY-MM
+    token = Column(String, primary_key=True)
+    token_count = Column(Integer)  # Occurrences in the business's reviews that month
+
+
+###Service Models###
+class IngestTicket(Base):
+    __tablename__ = 'ingest_tickets'
+
+    ticket_id = Column(String, primary_key=True)
+    table_name = Column(String)
+    status = Column(String)  # queued, applied or failed
+    received = Column(Integer)
+    applied = Column(Integer)
+    failed = Column(Integer)
+    error = Column(Text)
+    created = Column(DateTime)
+    updated = Column(DateTime)
+
+
+class AppliedBatch(Base):
+    __tablename__ = 'applied_batches'
+
+    fingerprint = Column(String, primary_key=True)  # Client hash of the POST package
+    table_name = Column(String)
+    record_count = Column(Integer)  # Records committed with the batch
+    applied_at = Column(DateTime, index=True)
@@ -1,13 +1,25 @@
+import itertools
 import logging
+import re
 from datetime import datetime
 # from multiprocessing import Pool
 from models import *
 from db import get_session, get_db
-from flask import current_app, g
-import numpy as np
-import time
-import ujson
-import re
+from upsert import upsert_records, fetch_existing, chunks
+from writer import get_coordinator
+from errors import InvalidUsage
+from timestamps import coerce_datetime_columns
+from validators import validate_records, rejection_report
+import response_cache
+import aggregates
+import search
+import fingerprints
+import guardrails
+import columnar
+import metrics
+from serializer import dumps
+from flask import current_app, g, Response, stream_with_context
+from sqlalchemy import and_, or_
 
 
 query_logger = logging.getLogger(__name__)
@@ -16,36 +28,30 @@ class Query():
     def __init__(self, query):
         self.query = query
 
-    def check_constraints(self, record, session):
-        """Check for constraints in a record.
-            If any found, create empty rows with needed keys to enforce relational constraints.
+    def check_constraints(self, records, session):
+        """Check for constraints in a batch of records.
+            Referenced keys are collected across the batch and resolved with one query per
+            parent table.  Missing parents are created as empty rows in a single INSERT inside
+            the batch's transaction (no commit here).
             Also handle known typing difficulties with SQL Alchemy (datetime)
         """
 
-        # DateTime Checks
-        query_logger.debug('Checking for datetime fields')
-        for field in ['date', 'yelping_since']:
-            if field in record.keys():
-                record[field] = convert_to_datetime(record[field])
+        # DateTime Checks.  Whole columns at once, format detected once per batch.
+        coerce_datetime_columns(records)
 
         # Foreign Key Checks
-        if 'business_id' in record.keys():
-            query_logger.debug('business_id found in query.  Checking for existing record.')
-            exists = session.query(Business).filter_by(business_id=record['business_id']).scalar() is not None
-            if not exists:
-                query_logger.info('business_id did not return existing row. Generating empty row.')
-                business = Business(business_id=record['business_id'])
-                session.add(business)
-                session.commit()
-
-        if 'user_id' in record.keys():
-            query_logger.debug('user_id found in query.  Checking for existing record.')
-            exists = session.query(User).filter_by(user_id=record['user_id']).scalar() is not None
-            if not exists:
-                query_logger.info('user_id did not return existing row. Generating empty row.')
-                user = User(user_id=record['user_id'])
-                session.add(user)
-                session.commit()
+        for model, key in [(Business, 'business_id'), (User, 'user_id')]:
+            if model.__tablename__ == self.query.get('table_name'):
+                # Rows of the parent table itself are created by the upsert
+                continue
+            referenced = {record[key] for record in records if record.get(key) is not None}
+            if not referenced:
+                continue
+            query_logger.debug('{} found in query.  Checking {} keys for existing records.'.format(key, len(referenced)))
+            missing = referenced - fetch_existing(session, model, key, referenced).keys()
+            if missing:
+                query_logger.info('{} {} keys did not return existing rows. Generating empty rows.'.format(len(missing), key))
+                session.execute(model.__table__.insert(), [{key: value} for value in sorted(missing)])
 
 
     def fill(self, data):
@@ -66,8 +72,28 @@ class Get(Query):
     def execute(self, params):
         assert type(params) == dict
         query_logger.info('GET query launching params = {}'.format(params))
-        with get_session() as session:
-            self.response = self.maker(session=session, params=params)
+        if params.get('format', 'json') != 'json':
+            # Arrow/Parquet bodies are built from the query result and not cached
+            if self.query['schema'] not in EXPORTERS:
+                raise InvalidUsage(message='Schema {} does not support format {}'.format(
+                    self.query['schema'], params['format']))
+            self.response = EXPORTERS[self.query['schema']](params, params['format'])
+            return
+        if params.get('stream'):
+            # Streamed responses hold their own session for the life of the response
+            if self.query['schema'] not in STREAMERS:
+                raise InvalidUsage(message='Schema {} does not support streaming'.format(self.query['schema']))
+            self.response = STREAMERS[self.query['schema']](params)
+            return
+        self.response = response_cache.cached(
+            schema=self.query['schema'], params=params, compute=lambda: self.run(params))
+
+    def run(self, params):
+        schema = self.query['schema']
+        with get_session('read') as session:
+            with guardrails.statement_timeout(session, schema):
+                guardrails.check_rows(schema, ROW_ESTIMATORS.get(schema), session, params)
+                return self.maker(session=session, params=params)
 
 
 class Post(Query):
@@ -82,11 +108,16 @@ class Post(Query):
         assert type(records) == list
         with get_session() as session:
             query_logger.info('Adding {} records to session stack.'.format(len(records)))
-            for record in records:
-                self.check_constraints(record=record, session=session)
-                self.maker(record=record, session=session)
+            self.check_constraints(records=records, session=session)
+            self.maker(records=records, session=session)
+            # Retried packages with these fingerprints are acknowledged without a write
+            fingerprints.record(session, self.query['table_name'], self.query.get('fingerprints'))
             query_logger.info('Stack comitted')
             session.commit()
+            # Makers add businesses they changed that are not named in the records
+            touched = session.info.get('touched_business_ids', set())
+        response_cache.invalidate_records(self.query['table_name'], records)
+        response_cache.invalidate(touched)
 
 
 ###################
@@ -105,31 +136,57 @@ def query_database(method, query):
         query = Get(query=query)
         return query.response
     elif method == 'POST':
-        run_post(query=query)  # Single-threaded operation
+        return run_post(query=query)
+
+
+def validate_post(query):
+    """Check the shape of a POST package before any work is queued."""
+    if query.get('table_name') not in POST_TABLES:
+        raise InvalidUsage(message='Unknown table_name {}.  Expected one of {}'.format(
+            query.get('table_name'), ', '.join(POST_TABLES)))
+    data = query.get('data')
+    if type(data) != list or not all(type(record) == dict for record in data):
+        raise InvalidUsage(message='data must be a list of records')
 
-    return {'message': 'POST received and executed'}
+
+def check_post(query):
+    """Validate a POST package and its records.  Returns (valid records, rejected).
+    Raises if every record was rejected.
+    """
+    validate_post(query)
+    records, rejected = validate_records(query['table_name'], query['data'])
+    if rejected and not records:
+        raise InvalidUsage(message='Every record in the batch was rejected',
+                           payload=rejection_report(rejected))
+    return records, rejected
 
 
 def run_post(query):
-    time.sleep(np.random.random_sample())
-    return Post(query=query)
-
-
-def convert_to_datetime(time_string):
-    query_logger.debug('Converting {} to datetime'.format(time_string))
-    try:
-        assert type(time_string) == str
-        return datetime.fromisoformat(time_string)
-    except ValueError:
-        query_logger.debug('Value Error: Invalid isoformat string')
-        query_logger.debug('Sending default datetime')
-        return datetime.fromisoformat('1969-01-01')
-    except AssertionError:
-        query_logger.debug('AssertionError: DateTime not a string.')
-        query_logger.debug('Attempting translation')
-        return datetime.fromtimestamp(time_string / 1e3)
-    except:
-        raise
+    """Hand the valid records to the table's writer thread and wait until they are committed.
+    Returns the POST response.
+    """
+    validate_post(query)
+    duplicate = fingerprints.find_applied(query)
+    if duplicate is not None:
+        return duplicate
+    records, rejected = check_post(query)  # Bad records fail here rather than in the writer
+    response = {'message': 'POST received and executed', 'applied': 0}
+    if records:
+        future = get_coordinator().submit(
+            table_name=query['table_name'], records=records, fingerprint=fingerprints.parse(query))
+        with metrics.timed('db_seconds'):  # The writer thread's SQL is not seen by this thread
+            result = future.result(timeout=current_app.config['WRITE_TIMEOUT'])
+        if result['duplicate']:
+            # Another request with this fingerprint committed first
+            return fingerprints.acknowledgement(result['applied'])
+        response['applied'] = result['applied']
+    response.update(rejection_report(rejected))
+    return response
+
+
+def apply_batch(table_name, records, batch_fingerprints=()):
+    # Writer thread entry point.  Records may be several requests' batches coalesced together.
+    return Post(query={'table_name': table_name, 'data': records, 'fingerprints': batch_fingerprints})
 
 
 def build_databunch(query, num_splits=3):
@@ -152,6 +209,11 @@ def build_databunch(query, num_splits=3):
 ###Make Instance Methods###
 ###########################
 
+# Schemas accepted by POST.  Everything else in assign_maker is a GET schema.
+POST_TABLES = ('businesses', 'users', 'checkins', 'photos', 'tips', 'reviews',
+               'review_sentiment', 'tip_sentiment', 'viz2')
+GET_SCHEMAS = ('biz_words', 'biz_comp', 'biz_stats', 'search_reviews', 'top_tokens')
+
 # TODO: Collapse into single maker factory that calls proper class
 def assign_maker(schema):
     makers = {
@@ -166,150 +228,302 @@ def assign_maker(schema):
         'viz2': make_or_update_viz2,
         'biz_words': biz_words,
         'biz_comp': biz_comp,
+        'biz_stats': biz_stats,
+        'search_reviews': search.search_reviews,
+        'top_tokens': top_tokens,
     }
     return makers[schema]
 
 
-def make_or_update_business(session, record, *args, **kwargs):
-    # Check if existing to UPDATE or INSERT
-    exists = session.query(Business).filter_by(business_id=record['business_id']).scalar() is not None
-    if not exists:
-        query_logger.debug('business_id did not return existing row. Creating new business instance')
-        session.add(Business(**record))
-    else:
-        session.query(Business).filter_by(business_id=record['business_id']).update(record)
+def make_or_update_business(session, records, *args, **kwargs):
+    upsert_records(session, Business, records, key='business_id')
 
 
-def make_or_update_user(session, record, *args, **kwargs):
-    # Check if existing to UPDATE or INSERT
-    exists = session.query(User).filter_by(user_id=record['user_id']).scalar() is not None
-    if not exists:
-        query_logger.debug('user_id did not return existing row. Creating new business instance')
-        session.add(User(**record))
-    else:
-        session.query(User).filter_by(user_id=record['user_id']).update(record)
+def make_or_update_user(session, records, *args, **kwargs):
+    upsert_records(session, User, records, key='user_id')
 
 
-def make_or_update_checkin(session, record, *args, **kwargs):
-    # Check if existing to UPDATE or INSERT
-    exists = session.query(Checkin).filter_by(checkin_id=record['checkin_id']).scalar() is not None
-    if not exists:
-        query_logger.debug('checkin_id did not return existing row. Creating new business instance')
-        session.add(Checkin(**record))
-    else:
-        session.query(Checkin).filter_by(checkin_id=record['checkin_id']).update(record)
+def make_or_update_checkin(session, records, *args, **kwargs):
+    upsert_records(session, Checkin, records, key='checkin_id')
 
 
-def make_or_update_photo(session, record, *args, **kwargs):
-    # Check if existing to UPDATE or INSERT
-    exists = session.query(Photo).filter_by(photo_id=record['photo_id']).scalar() is not None
-    if not exists:
-        query_logger.debug('photo_id did not return existing row. Creating new business instance')
-        session.add(Photo(**record))
-    else:
-        session.query(Photo).filter_by(photo_id=record['photo_id']).update(record)
+def make_or_update_photo(session, records, *args, **kwargs):
+    upsert_records(session, Photo, records, key='photo_id')
 
 
-def make_or_update_tip(session, record, *args, **kwargs):
-    # Check if existing to UPDATE or INSERT
-    exists = session.query(Tip).filter_by(tip_id=record['tip_id']).scalar() is not None
-    if not exists:
-        query_logger.debug('tip_id did not return existing row. Creating new business instance')
-        session.add(Tip(**record))
-    else:
-        session.query(Tip).filter_by(tip_id=record['tip_id']).update(record)
+def make_or_update_tip(session, records, *args, **kwargs):
+    upsert_records(session, Tip, records, key='tip_id')
 
 
-def make_or_update_review(session, record, *args, **kwargs):
-    # Check if existing to UPDATE or INSERT
-    exists = session.query(Review).filter_by(review_id=record['review_id']).scalar() is not None
-    if not exists:
-        query_logger.debug('review_id did not return existing row. Creating new business instance')
-        session.add(Review(**record))
-    else:
-        session.query(Review).filter_by(review_id=record['review_id']).update(record)
-
-
-def make_or_update_review_sentiment(session, record, *args, **kwargs):
-    # Check if existing to UPDATE or INSERT
-    try:
-        exists = session.query(ReviewSentiment).filter_by(review_id=record['review_id']).scalar() is not None
-    except:
-        query_logger.info('Error in .scalar(). Multiple Found?.  Exception in alchemy ret one()')
-        query_logger.info('')
-        exists = False
-    if not exists:
-        query_logger.debug('review_id did not return existing row. Creating new business instance')
-        session.add(ReviewSentiment(**record))
-    else:
-        session.query(ReviewSentiment).filter_by(review_id=record['review_id']).update(record)
-
-
-def make_or_update_tip_sentiment(session, record, *args, **kwargs):
-    # Check if existing to UPDATE or INSERT
-    try:
-        exists = session.query(TipSentiment).filter_by(tip_id=record['tip_id']).scalar() is not None
-    except:
-        query_logger.info('Error in .scalar(). Multiple Found?. Exception in alchemy ret one()')
-        exists = False
-    if not exists:
-        query_logger.debug('tip_id did not return existing row. Creating new business instance')
-        session.add(TipSentiment(**record))
-    else:
-        session.query(TipSentiment).filter_by(tip_id=record['tip_id']).update(record)
-
-
-def make_or_update_viz2(session, record, *args, **kwargs):
-    # Check if existing to UPDATE or INSERT
-    for key in record.keys():
-        if type(record[key]) == dict:
-            record[key] = str(record[key])
-    try:
-        exists = session.query(Viz2).filter_by(business_id=record['business_id']).scalar() is not None
-    except:
-        query_logger.info('Error in .scalar(). Multiple Found?. Exception in alchemy ret one()')
-        exists = False
-    if not exists:
-        query_logger.debug('business_id did not return existing row. Creating new viz2 instance')
-        session.add(Viz2(**record))
-    else:
-        session.query(Viz2).filter_by(business_id=record['business_id']).update(record)
+def make_or_update_review(session, records, *args, **kwargs):
+    # Aggregate deltas need the stored rows, so they are applied before the upsert
+    touched = aggregates.update_for_reviews(session, records)
+    session.info.setdefault('touched_business_ids', set()).update(touched)
+    upsert_records(session, Review, records, key='review_id')
+    search.sync_reviews(session, records)  # Needs the rows written above
+
+
+def make_or_update_review_sentiment(session, records, *args, **kwargs):
+    # Keyed on review_id rather than the rs_id primary key.  Duplicate review_ids are all updated.
+    upsert_records(session, ReviewSentiment, records, key='review_id')
+
+
+def make_or_update_tip_sentiment(session, records, *args, **kwargs):
+    # Keyed on tip_id rather than the ts_id primary key.  Duplicate tip_ids are all updated.
+    upsert_records(session, TipSentiment, records, key='tip_id')
+
+
+def make_or_update_viz2(session, records, *args, **kwargs):
+    # Aggregate fields were parsed to their JSON shapes by validation (validators.NORMALIZERS)
+    upsert_records(session, Viz2, records, key='business_id')
 
 
 # GET ENDPOINT FUNCTIONS #
 # ------------------------
 
+def get_business_ids(params):
+    """business_ids list for batch requests, None for single business requests."""
+    if 'business_ids' not in params:
+        if not params.get('business_id'):
+            raise InvalidUsage(message='business_id or business_ids required')
+        return None
+    business_ids = params['business_ids']
+    if type(business_ids) != list or not business_ids or not all(type(b) == str for b in business_ids):
+        raise InvalidUsage(message='business_ids must be a non-empty list of business_id strings')
+    if params.get('limit') is not None or params.get('stream'):
+        raise InvalidUsage(message='limit and stream apply to a single business_id only')
+    return list(dict.fromkeys(business_ids))  # Drop duplicates, keep order
+
+
+def biz_words_queries(session, params):
+    """(date, token, stars, review_id) for a business, as one query per phase: reviews without
+    a date in review_id order, then dated reviews in (date, review_id) order.  Each phase is
+    read in index order from ix_reviews_business_id_date_review_id.
+    Optional keyset pagination: after_date (isoformat) [+ after_review_id] and limit.
+    after_review_id alone continues inside the reviews without a date.
+    """
+    if params.get('limit') is not None:
+        if type(params['limit']) != int or params['limit'] < 1:
+            raise InvalidUsage(message='limit must be a positive integer')
+    response = session.query(Review.date, Review.token, Review.stars, Review.review_id).\
+        filter(Review.business_id==params['business_id'])
+    if params.get('after_date'):
+        try:
+            after_date = datetime.fromisoformat(params['after_date'])
+        except (TypeError, ValueError):
+            raise InvalidUsage(message='after_date must be an isoformat datetime string')
+        if params.get('after_review_id'):
+            dated = response.filter(or_(
+                Review.date > after_date,
+                and_(Review.date == after_date, Review.review_id > params['after_review_id'])))
+        else:
+            dated = response.filter(Review.date > after_date)
+        return [dated.order_by(Review.date, Review.review_id)]
+    undated = response.filter(Review.date.is_(None))
+    if params.get('after_review_id'):
+        undated = undated.filter(Review.review_id > params['after_review_id'])
+    return [undated.order_by(Review.review_id),
+            response.filter(Review.date.isnot(None)).order_by(Review.date, Review.review_id)]
+
+
 def biz_words(session, params, *args, **kwargs):
-    response = session.query(Review.date, Review.token, Review.stars).\
-        filter(Review.business_id==params['business_id']).order_by(Review.date)
-    return {'data': response.all()}
+    business_ids = get_business_ids(params)
+    if business_ids is not None:
+        return biz_words_batch(session, business_ids)
+    limit = params.get('limit')
+    rows = []
+    for response in biz_words_queries(session, params):
+        if limit is not None:
+            if len(rows) == limit:
+                break
+            response = response.limit(limit - len(rows))
+        rows.extend(guardrails.cap('biz_words', response, limit).all())
+        guardrails.check_fetched('biz_words', len(rows))
+    package = {'data': [row[:3] for row in rows]}
+    if limit is not None:
+        # Cursor for the next page, None when this page is the last
+        package['next'] = None
+        if len(rows) == limit:
+            last = rows[-1]
+            package['next'] = {'after_date': last.date.isoformat() if last.date is not None else None,
+                               'after_review_id': last.review_id}
+    return package
+
+
+def biz_words_batch(session, business_ids):
+    # One query for every business, answered as {business_id: [[date, token, stars], ...]}
+    package = {business_id: [] for business_id in business_ids}
+    fetched = 0
+    for chunk in chunks(business_ids):
+        rows = session.query(Review.business_id, Review.date, Review.token, Review.stars).\
+            filter(Review.business_id.in_(chunk)).\
+            order_by(Review.business_id, Review.date, Review.review_id)
+        rows = guardrails.cap('biz_words', rows).all()
+        fetched += len(rows)
+        guardrails.check_fetched('biz_words', fetched)
+        for row in rows:
+            package[row.business_id].append(row[1:])
+    return {'data': package}
+
+
+def stream_biz_words(params, chunk_size=1000):
+    """Stream biz_words rows as chunked JSON straight from a server-side cursor."""
+    def generate():
+        with get_session('read') as session, guardrails.stream_timeout(session, 'biz_words'):
+            yield b'{"data":['
+            chunk = []
+            first = True
+            for row in itertools.chain.from_iterable(
+                    response.yield_per(chunk_size) for response in biz_words_queries(session, params)):
+                chunk.append(row[:3])
+                if len(chunk) == chunk_size:
+                    # Encode the chunk as a list and drop its brackets
+                    yield (b'' if first else b',') + dumps(chunk)[1:-1]
+                    chunk, first = [], False
+            if chunk:
+                yield (b'' if first else b',') + dumps(chunk)[1:-1]
+            yield b']}'
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def export_biz_words(params, fmt, chunk_size=10000):
+    """biz_words as an Arrow/Parquet stream.  Batch requests add a business_id column."""
+    business_ids = get_business_ids(params)
+    if business_ids is None:
+        columns = [Review.date, Review.token, Review.stars]
+    else:
+        columns = [Review.business_id, Review.date, Review.token, Review.stars]
+    columnar.check_format(fmt)
+
+    def row_chunks():
+        with get_session('read') as session, guardrails.stream_timeout(session, 'biz_words'):
+            if business_ids is None:
+                queries = biz_words_queries(session, params)
+            else:
+                queries = [session.query(Review.business_id, Review.date, Review.token, Review.stars).
+                           filter(Review.business_id.in_(chunk)).
+                           order_by(Review.business_id, Review.date, Review.review_id)
+                           for chunk in chunks(business_ids)]
+            rows = []
+            for response in queries:
+                for row in response.yield_per(chunk_size):
+                    rows.append(row)
+                    if len(rows) == chunk_size:
+                        yield rows
+                        rows = []
+            if rows:
+                yield rows
+
+    return columnar.stream_rows(fmt, columns, row_chunks())
+
+
+def export_biz_comp(params, fmt):
+    """biz_comp packages as a single Arrow/Parquet table, one row per business."""
+    columnar.check_format(fmt)
+    with get_session('read') as session, guardrails.stream_timeout(session, 'biz_comp'):
+        response = biz_comp(session, params)
+    packages = list(response['data'].values()) if 'data' in response else [response]
+    return columnar.table_response(fmt, [package for package in packages if package is not None])
+
+
+# GET schemas with columnar responses (params: format='arrow'|'parquet')
+EXPORTERS = {
+    'biz_words': export_biz_words,
+    'biz_comp': export_biz_comp,
+}
+
+
+# GET schemas that can stream their response (params: stream=True)
+STREAMERS = {
+    'biz_words': stream_biz_words,
+}
+
+
+def estimate_biz_words(session, params):
+    # Rows biz_words would return, from the review counts kept by aggregates.py
+    business_ids = get_business_ids(params)
+    if business_ids is not None:
+        return sum(aggregates.review_counts(session, business_ids).values())
+    if params.get('after_date') or params.get('after_review_id'):
+        # Later pages: count what is left after the cursor
+        rows = sum(response.order_by(None).count() for response in biz_words_queries(session, dict(params, limit=None)))
+    else:
+        rows = aggregates.review_counts(session, [params['business_id']])[params['business_id']]
+    return min(rows, params['limit']) if type(params.get('limit')) == int else rows
 
 
-def biz_comp(session, params, *args, **kwargs):
+def count_businesses(session, params):
+    # One package per business
+    business_ids = get_business_ids(params)
+    return 1 if business_ids is None else len(business_ids)
+
+
+# GET schemas costed before they run (guardrails.QUERY_MAX_ROWS)
+ROW_ESTIMATORS = {
+    'biz_words': estimate_biz_words,
+    'biz_comp': count_businesses,
+    'biz_stats': count_businesses,
+}
+
+
+def biz_comp_query(session, business_ids):
     # Join select business information to viz2 aggregation data on business_id
-    response = session.query(
+    return session.query(
             Business.business_id, Business.address, Business.city, Business.state,
             Business.postal_code, Business.review_count, Viz2.categories, Viz2.percentile,
             Viz2.competitors, Viz2.bestinsector, Viz2.avg_stars_over_time, Viz2.chunk_sentiment,
             Viz2.count_by_star, Viz2.review_by_year).\
-            join(Viz2).filter(Business.business_id == params['business_id']).all()
-    
-    # Get first row (could use first() as well) and package output for easier processing
-    response = response[0]
-    # Parse nested fields into more readible format
-    def get_components(element):
-        return re.findall(r'\[([^]]+)\]', element)
-    def strip_json_artifacts(element):
-        return element.strip().strip("'")
-
-    avg_stars_components = get_components(response.avg_stars_over_time)
-    dates = [strip_json_artifacts(x) for x in avg_stars_components[1].split(',')]
-    avg_stars = [float(x) for x in avg_stars_components[0].split(',')]
-    
-    chunk_sentiment_components = get_components(response.chunk_sentiment)
-    noun_chunks = [strip_json_artifacts(x) for x in chunk_sentiment_components[0].split(',')]
-    chunk_sentiment = [float(strip_json_artifacts(x)) for x in chunk_sentiment_components[1].split(',')]
+            join(Viz2).filter(Business.business_id.in_(business_ids))
 
+
+def biz_comp(session, params, *args, **kwargs):
+    business_ids = get_business_ids(params)
+    if business_ids is not None:
+        # One joined query for every business, answered as {business_id: package or None}
+        package = {business_id: None for business_id in business_ids}
+        for chunk in chunks(business_ids):
+            for response in biz_comp_query(session, chunk):
+                package[response.business_id] = package_biz_comp(response)
+        return {'data': package}
+
+    response = biz_comp_query(session, [params['business_id']]).first()
+    if response is None:
+        raise InvalidUsage(message='No viz2 data for business_id {}'.format(params['business_id']), status_code=404)
+    return package_biz_comp(response)
+
+
+def biz_stats(session, params, *args, **kwargs):
+    # Review count, average stars, reviews per year and star histogram from the aggregate tables
+    business_ids = get_business_ids(params)
+    if business_ids is not None:
+        return {'data': aggregates.read_stats(session, business_ids)}
+    package = aggregates.read_stats(session, [params['business_id']])[params['business_id']]
+    if package is None:
+        raise InvalidUsage(message='No reviews for business_id {}'.format(params['business_id']), status_code=404)
+    return package
+
+
+def top_tokens(session, params, *args, **kwargs):
+    # Most frequent review tokens for a business, optionally between two months (YYYY-MM, inclusive)
+    if type(params.get('business_id')) != str:
+        raise InvalidUsage(message='business_id required')
+    periods = {}
+    for field in ['start', 'end']:
+        value = params.get(field)
+        if value is not None and (type(value) != str or not re.match(r'^\d{4}-\d{2}', value)):
+            raise InvalidUsage(message='{} must be YYYY-MM or an isoformat date'.format(field))
+        periods[field] = value[:7] if value else None
+    k = params.get('k', 25)
+    if type(k) != int or not 1 <= k <= 500:
+        raise InvalidUsage(message='k must be an integer from 1 to 500')
+    rows = aggregates.read_top_tokens(session, params['business_id'], periods['start'], periods['end'], k)
+    return {'data': [{'token': token, 'count': count} for token, count in rows]}
+
+
+def package_biz_comp(response):
+    # Nested fields are stored pre-parsed (see viz2.py)
+    avg_stars_over_time = response.avg_stars_over_time or {}
+    chunk_sentiment = response.chunk_sentiment or {}
     package = {
         'business_id': response.business_id,
         'address': response.address,
@@ -319,16 +533,14 @@ def biz_comp(session, params, *args, **kwargs):
         'review_count': response.review_count,
         'categories': response.categories,
         'percentile': response.percentile,
-        'competitors': [strip_json_artifacts(x) for x in ujson.loads(
-                        response.competitors).strip('[]').split(',')],
-        'bestinsector': [strip_json_artifacts(x) for x in ujson.loads(
-                        response.bestinsector).strip("[]").split(',')],
-        'avg_stars': avg_stars,
-        'dates': dates,
-        'noun_chunks': noun_chunks,
-        'chunk_sentiment': chunk_sentiment,
-        'count_by_star': eval(response.count_by_star), 
-        'review_by_year': eval(response.review_by_year),
+        'competitors': response.competitors,
+        'bestinsector': response.bestinsector,
+        'avg_stars': avg_stars_over_time.get('avg_stars'),
+        'dates': avg_stars_over_time.get('dates'),
+        'noun_chunks': chunk_sentiment.get('noun_chunks'),
+        'chunk_sentiment': chunk_sentiment.get('chunk_sentiment'),
+        'count_by_star': response.count_by_star,
+        'review_by_year': response.review_by_year,
     }
 
-    return package
\ No newline at end of file
+    return package
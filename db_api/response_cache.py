@@ -0,0 +1,85 @@
+"""
+Response Cache
+    GET schema responses cached by (schema, params) with a TTL per schema.
+
+    Every key embeds a generation token for each business it covers.  A committed POST
+    that touches a business (reviews, viz2, businesses) replaces that business's token, so
+    older entries are never read again and expire on their own.  Works with any
+    flask_caching backend.  The default 'simple' backend is per worker process; use a
+    shared backend (CACHE_TYPE=redis) so invalidation reaches every worker.
+"""
+import hashlib
+import logging
+import uuid
+
+import ujson
+from flask import current_app
+
+
+cache_logger = logging.getLogger(__name__)
+
+# Tables whose writes change what cached schemas return
+INVALIDATING_TABLES = ('reviews', 'viz2', 'businesses')
+
+
+def get_cache():
+    return current_app.extensions['response_cache']
+
+
+def schema_timeout(schema):
+    # 0 or missing means the schema is not cached
+    return current_app.config['CACHE_SCHEMA_TIMEOUTS'].get(schema, 0)
+
+
+def business_ids_of(params):
+    if type(params.get('business_ids')) == list:
+        return sorted(set(str(b) for b in params['business_ids']))
+    return [params['business_id']] if params.get('business_id') else []
+
+
+def generation_key(business_id):
+    return 'gen:' + business_id
+
+
+def make_key(cache, schema, params):
+    digest = hashlib.sha1(ujson.dumps(params, sort_keys=True).encode()).hexdigest()
+    generations = [g or '0' for g in cache.get_many(*[generation_key(b) for b in business_ids_of(params)])]
+    return 'get:{}:{}:{}'.format(schema, digest, '.'.join(generations))
+
+
+def cached(schema, params, compute):
+    """Return the cached response for (schema, params) or compute() and store it."""
+    timeout = schema_timeout(schema)
+    if not timeout:
+        return compute()
+    cache = get_cache()
+    key = make_key(cache, schema, params)
+    response = cache.get(key)
+    if response is not None:
+        cache_logger.debug('Cache hit for {}'.format(key))
+        return response
+    response = compute()
+    cache.set(key, response, timeout=timeout)
+    return response
+
+
+def invalidate(business_ids):
+    """Retire cached responses for business_ids."""
+    if not business_ids:
+        return
+    cache = get_cache()
+    # Generation tokens outlive every entry created under the previous token
+    timeout = max(current_app.config['CACHE_SCHEMA_TIMEOUTS'].values() or [0]) + 1
+    token = uuid.uuid4().hex[:12]
+    cache.set_many({generation_key(b): token for b in business_ids}, timeout=timeout)
+    cache_logger.debug('Invalidated cached responses for {} businesses'.format(len(business_ids)))
+
+
+def invalidate_records(table_name, records):
+    # Called after a POST batch commits
+    if table_name in INVALIDATING_TABLES:
+        invalidate({record['business_id'] for record in records if record.get('business_id')})
+
+
+def init_app(app, cache):
+    app.extensions['response_cache'] = cache
@@ -0,0 +1,158 @@
+"""
+Review Search
+    Full-text search over Review.text for the search_reviews GET schema.
+
+    SQLite: an FTS5 table (reviews_fts) keyed by the reviews rowid.  The review upsert
+    rewrites the entries of every posted review that carries text, in the batch's
+    transaction.  VACUUM can renumber rowids: run flask rebuild-search after it.
+    PostgreSQL: a GIN index on to_tsvector('english', text).  The index is maintained by
+    the database, so the upsert has nothing to do.
+
+    init-db installs the index on new databases.  flask rebuild-search installs it on an
+    existing database and (re)fills the SQLite table.
+"""
+import logging
+import re
+
+from sqlalchemy import DateTime, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from errors import InvalidUsage
+from upsert import chunks
+
+
+search_logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'reviews_fts'
+PG_INDEX = 'ix_reviews_text_fts'
+MAX_LIMIT = 100
+DEFAULT_LIMIT = 20
+
+# Porter stemming on SQLite to match the 'english' configuration on PostgreSQL
+SQLITE_DDL = "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(text, tokenize='porter unicode61')".format(FTS_TABLE)
+PG_DDL = "CREATE INDEX IF NOT EXISTS {} ON reviews USING gin (to_tsvector('english', coalesce(text, '')))".format(PG_INDEX)
+
+# Engines (by URL) known to have the SQLite FTS table.  Checked once per process.
+_sqlite_fts = {}
+
+
+def install(engine):
+    """Create the full-text index for engine's dialect if it is missing."""
+    if engine.dialect.name == 'sqlite':
+        try:
+            engine.execute(SQLITE_DDL)
+        except OperationalError as e:
+            search_logger.warning('FTS5 unavailable, search_reviews disabled: {}'.format(e))
+            return False
+        _sqlite_fts.pop(str(engine.url), None)
+    elif engine.dialect.name == 'postgresql':
+        engine.execute(PG_DDL)
+    else:
+        return False
+    return True
+
+
+def has_sqlite_fts(connection):
+    key = str(connection.engine.url)
+    if key not in _sqlite_fts:
+        _sqlite_fts[key] = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = :name"), {'name': FTS_TABLE}).scalar() is not None
+    return _sqlite_fts[key]
+
+
+def sync_reviews(session, records):
+    """Re-index posted reviews that carry text.  Call after the upsert,
+    inside the same session.  No-op except on SQLite with the FTS table installed.
+    """
+    connection = session.connection()
+    if connection.dialect.name != 'sqlite' or not has_sqlite_fts(connection):
+        return
+    review_ids = list({record['review_id'] for record in records if 'text' in record})
+    for chunk in chunks(review_ids):
+        binds = ', '.join(':id{}'.format(i) for i in range(len(chunk)))
+        params = {'id{}'.format(i): review_id for i, review_id in enumerate(chunk)}
+        session.execute(text(
+            'DELETE FROM {} WHERE rowid IN (SELECT rowid FROM reviews WHERE review_id IN ({}))'.format(
+                FTS_TABLE, binds)), params)
+        session.execute(text(
+            'INSERT INTO {} (rowid, text) SELECT rowid, text FROM reviews '
+            'WHERE review_id IN ({}) AND text IS NOT NULL'.format(FTS_TABLE, binds)), params)
+
+
+def rebuild(engine):
+    """Install the index and re-fill the SQLite table from reviews.  Returns rows indexed."""
+    if not install(engine):
+        raise RuntimeError('Full-text search is not available on {}'.format(engine.dialect.name))
+    with engine.begin() as connection:
+        if engine.dialect.name == 'sqlite':
+            connection.execute('DELETE FROM {}'.format(FTS_TABLE))
+            connection.execute('INSERT INTO {} (rowid, text) SELECT rowid, text FROM reviews '
+                               'WHERE text IS NOT NULL'.format(FTS_TABLE))
+        return connection.execute('SELECT count(*) FROM reviews WHERE text IS NOT NULL').scalar()
+
+
+###Queries###
+def parse_params(params):
+    if type(params.get('query')) != str:
+        raise InvalidUsage(message='query (search text) required')
+    terms = re.findall(r'\w+', params['query'].lower())
+    if not terms:
+        raise InvalidUsage(message='query must contain at least one word')
+    limit = params.get('limit', DEFAULT_LIMIT)
+    if type(limit) != int or not 1 <= limit <= MAX_LIMIT:
+        raise InvalidUsage(message='limit must be an integer from 1 to {}'.format(MAX_LIMIT))
+    if params.get('business_id') is not None and type(params['business_id']) != str:
+        raise InvalidUsage(message='business_id must be a string')
+    return terms, limit
+
+
+def sqlite_search(session, terms, operator, business_id, limit):
+    # Terms are quoted so FTS5 query syntax in user input is matched literally.  bm25: lower is better.
+    match = ' {} '.format(operator).join('"{}"'.format(term) for term in terms)
+    sql = ("SELECT reviews.review_id, reviews.business_id, reviews.date, reviews.stars, "
+           "snippet({fts}, 0, '[', ']', '...', 12) AS snippet, -{fts}.rank AS score "
+           "FROM {fts} JOIN reviews ON reviews.rowid = {fts}.rowid "
+           "WHERE {fts} MATCH :match {business} ORDER BY {fts}.rank LIMIT :limit").format(
+        fts=FTS_TABLE, business='AND reviews.business_id = :business_id' if business_id else '')
+    return session.execute(text(sql).columns(date=DateTime), {'match': match, 'business_id': business_id, 'limit': limit})
+
+
+def postgres_search(session, terms, operator, business_id, limit):
+    tsquery = ' {} '.format('&' if operator == 'AND' else '|').join(terms)
+    sql = ("SELECT review_id, business_id, date, stars, "
+           "ts_headline('english', text, q, 'StartSel=[, StopSel=], MaxWords=24') AS snippet, "
+           "ts_rank(to_tsvector('english', coalesce(text, '')), q) AS score "
+           "FROM reviews, to_tsquery('english', :tsquery) AS q "
+           "WHERE to_tsvector('english', coalesce(text, '')) @@ q {business} "
+           "ORDER BY score DESC LIMIT :limit").format(
+        business='AND business_id = :business_id' if business_id else '')
+    return session.execute(text(sql).columns(date=DateTime), {'tsquery': tsquery, 'business_id': business_id, 'limit': limit})
+
+
+def search_reviews(session, params, *args, **kwargs):
+    """Reviews matching params['query'], best match first.
+    params: query (all words must match, or any word with 'any': True), business_id, limit
+    """
+    terms, limit = parse_params(params)
+    operator = 'OR' if params.get('any') else 'AND'
+    dialect = session.bind.dialect.name
+    try:
+        if dialect == 'sqlite':
+            rows = sqlite_search(session, terms, operator, params.get('business_id'), limit)
+        elif dialect == 'postgresql':
+            rows = postgres_search(session, terms, operator, params.get('business_id'), limit)
+        else:
+            raise InvalidUsage(message='search_reviews is not supported on {}'.format(dialect), status_code=501)
+        rows = rows.fetchall()
+    except (OperationalError, ProgrammingError) as e:
+        if FTS_TABLE not in str(e):
+            raise
+        raise InvalidUsage(message='Search index not built.  Run flask rebuild-search.', status_code=503)
+    return {'data': [{
+        'review_id': row.review_id,
+        'business_id': row.business_id,
+        'date': row.date,
+        'stars': row.stars,
+        'snippet': row.snippet,
+        'score': row.score,
+    } for row in rows]}
@@ -0,0 +1,371 @@
+"""
+Local tests for db_api
+    Run from this directory:  python -m pytest test_db_api.py
+    Each test builds the app in-process against a fresh SQLite file (benchmarks/common.py).
+    tests.py is the older script that posts sample data to the staging deployment.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+from common import make_app, make_records, random_id
+
+
+@pytest.fixture
+def app():
+    return make_app(CACHE_SCHEMA_TIMEOUTS={})
+
+
+###Database###
+def test_read_only_sqlite_read_uri(tmp_path):
+    import db
+    path = str(tmp_path / 'test.sqlite3')
+    app = make_app(db_path=path, CACHE_SCHEMA_TIMEOUTS={},
+                   DATABASE_READ_URI='sqlite:///file:{}?mode=ro&uri=true'.format(path))
+    business_id = random_id()
+    client = app.test_client()
+    records = make_records('reviews', 3, [business_id], [random_id()])
+    assert client.post('/api/data', json={'table_name': 'reviews', 'data': records}).status_code == 200
+    response = client.get('/api/data', json={'schema': 'biz_words', 'params': {'business_id': business_id}})
+    assert response.status_code == 200
+    assert len(response.get_json()['data']) == 3
+    with app.app_context(), pytest.raises(Exception, match='readonly'):
+        with db.get_db('read').begin() as connection:
+            connection.execute('DELETE FROM reviews')
+
+
+###Writer###
+def test_writer_survives_failed_duplicate_lookup(app):
+    import writer
+    with app.app_context():
+        coordinator = writer.get_coordinator()
+        lookup = coordinator.applied
+        calls = []
+
+        def flaky(fingerprints):
+            calls.append(fingerprints)
+            if len(calls) == 1:
+                raise RuntimeError('database went away')
+            return lookup(fingerprints)
+        coordinator.applied = flaky
+
+        first = coordinator.submit('users', make_records('users', 2, [random_id()], [random_id()]), fingerprint='a' * 40)
+        with pytest.raises(RuntimeError):
+            first.result(timeout=10)
+        second = coordinator.submit('users', make_records('users', 3, [random_id()], [random_id()]), fingerprint='b' * 40)
+        assert second.result(timeout=10) == {'applied': 3, 'duplicate': False}
+        assert coordinator.status()['users']['queue_depth'] == 0
+
+
+def test_resent_fingerprints_are_not_written_again(app):
+    import threading
+    import db
+    import writer
+    from models import User
+    client = app.test_client()
+    records = make_records('users', 3, [random_id()], [random_id()])
+    package = {'table_name': 'users', 'data': records, 'fingerprint': 'c' * 40}
+    assert client.post('/api/data', json=package).get_json()['applied'] == 3
+    resent = dict(package, data=[dict(record, name='changed') for record in records])
+    assert client.post('/api/data', json=resent).get_json() == \
+        {'message': 'POST already applied', 'applied': 3, 'duplicate': True}
+    with app.app_context():
+        with db.get_session() as session:
+            assert session.query(User).filter(User.name == 'changed').count() == 0
+        coordinator = writer.get_coordinator()
+        assert coordinator.status()['users']['commits'] == 1
+
+        # Hold the writer on a first batch so the two copies below queue up as one group
+        lookup = coordinator.applied
+        release = threading.Event()
+
+        def held(fingerprints):
+            release.wait(timeout=10)
+            return lookup(fingerprints)
+        coordinator.applied = held
+        first = coordinator.submit('users', make_records('users', 1, [random_id()], [random_id()]), fingerprint='d' * 40)
+        batch = make_records('users', 2, [random_id()], [random_id()])
+        copies = [coordinator.submit('users', batch, fingerprint='e' * 40) for _ in range(2)]
+        release.set()
+        assert first.result(timeout=10) == {'applied': 1, 'duplicate': False}
+        assert [copy.result(timeout=10) for copy in copies] == [
+            {'applied': 2, 'duplicate': False}, {'applied': 2, 'duplicate': True}]
+        assert coordinator.status()['users']['duplicates'] == 1
+
+
+###Validation###
+def test_records_without_key_are_rejected(app):
+    records = make_records('reviews', 3, [random_id()], [random_id()])
+    del records[1]['review_id']
+    records[2]['review_id'] = None
+    response = app.test_client().post('/api/data', json={'table_name': 'reviews', 'data': records})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['applied'] == 1
+    assert [error['index'] for error in body['errors']] == [1, 2]
+    assert 'review_id' in body['errors'][0]['errors']
+
+
+def test_unparsable_viz2_fields_are_rejected(app):
+    business_ids = [random_id() for _ in range(5)]
+    good = {'business_id': business_ids[0], 'competitors': str(business_ids[1:3]),
+            'count_by_star': str({1: 2, 5: 7}), 'avg_stars_over_time': str(([4.0, 4.5], ['2018', '2019']))}
+    bad = [
+        {'business_id': business_ids[1], 'count_by_star': 'garbage'},
+        {'business_id': business_ids[2], 'avg_stars_over_time': 5},
+        {'business_id': business_ids[3], 'competitors': '7'},
+    ]
+    response = app.test_client().post('/api/data', json={'table_name': 'viz2', 'data': [good] + bad})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['applied'] == 1
+    assert [list(error['errors']) for error in body['errors']] == [
+        ['count_by_star'], ['avg_stars_over_time'], ['competitors']]
+
+    response = app.test_client().post('/api/data', json={'table_name': 'viz2', 'data': bad})
+    assert response.status_code == 400
+    assert response.get_json()['rejected'] == 3
+
+
+def test_out_of_range_epoch_ms_are_rejected(app):
+    records = make_records('reviews', 4, [random_id()], [random_id()])
+    for record, date in zip(records, [1.5e12, 3e14, 1e16, -1e15]):
+        record['date'] = date
+    response = app.test_client().post('/api/data', json={'table_name': 'reviews', 'data': records})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['applied'] == 1
+    assert [(error['index'], list(error['errors'])) for error in body['errors']] == [
+        (1, ['date']), (2, ['date']), (3, ['date'])]
+
+
+###Metrics###
+def test_metrics_label_only_known_schemas(app):
+    import metrics
+    client = app.test_client()
+    injected = 'x"} 1\ndb_api_fake_total{schema="y'
+    assert client.get('/api/data', json={'schema': injected, 'params': {}}).status_code >= 400
+    assert client.post('/api/data', json={'table_name': 'reviews', 'data': 5}).status_code == 400
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'db_api_fake_total' not in text
+    assert 'method="GET",schema="unknown"' in text
+    assert metrics.format_labels(('schema',), ('a\\b"c\nd',)) == 'schema="a\\\\b\\"c\\nd"'
+
+
+###Queries###
+def test_biz_words_pages_through_null_dates(app):
+    business_id = random_id()
+    records = make_records('reviews', 7, [business_id], [random_id()])
+    for record in records[:3]:
+        record['date'] = None
+    client = app.test_client()
+    assert client.post('/api/data', json={'table_name': 'reviews', 'data': records}).status_code == 200
+
+    params = {'business_id': business_id, 'limit': 2}
+    dates = []
+    while True:
+        response = client.get('/api/data', json={'schema': 'biz_words', 'params': params})
+        assert response.status_code == 200
+        page = response.get_json()
+        dates.extend(row[0] for row in page['data'])
+        if page['next'] is None:
+            break
+        params = dict(params, **page['next'])
+    assert len(dates) == 7
+    assert dates[:3] == [None] * 3 and None not in dates[3:]
+
+
+def test_dates_keep_flask_format(app):
+    business_id = random_id()
+    records = make_records('reviews', 1, [business_id], [random_id()])
+    records[0]['date'] = '2019-01-02T03:04:05'
+    client = app.test_client()
+    assert client.post('/api/data', json={'table_name': 'reviews', 'data': records}).status_code == 200
+    for params in ({'business_id': business_id}, {'business_id': business_id, 'stream': True}):
+        response = client.get('/api/data', json={'schema': 'biz_words', 'params': params})
+        assert response.get_json()['data'][0][0] == 'Wed, 02 Jan 2019 03:04:05 GMT'
+
+
+def test_http_date_matches_werkzeug():
+    import datetime
+    import random
+    from werkzeug.http import http_date
+    import serializer
+    offset = datetime.timezone(datetime.timedelta(hours=-7))
+    for _ in range(1000):
+        value = datetime.datetime(1900, 1, 1) + datetime.timedelta(seconds=random.randrange(200 * 365 * 86400))
+        assert serializer.http_date(value) == http_date(value.utctimetuple())
+        aware = value.replace(tzinfo=offset)
+        assert serializer.http_date(aware) == http_date(aware.utctimetuple())
+        day = value.date()
+        assert serializer.default(day) == http_date(day.timetuple())
+
+
+###Aggregates###
+def test_incremental_aggregates_match_rebuild(app):
+    import aggregates
+    import db
+    client = app.test_client()
+
+    def post(records):
+        response = client.post('/api/data', json={'table_name': 'reviews', 'data': records})
+        assert response.status_code == 200 and response.get_json()['rejected'] == 0
+
+    def snapshot():
+        # Rows counted down to 0 are kept by updates and dropped by rebuild
+        tables = {}
+        with db.get_session() as session:
+            for model in aggregates.AGGREGATE_MODELS:
+                count = 'token_count' if model is aggregates.TokenPosting else 'review_count'
+                tables[model.__tablename__] = sorted(
+                    tuple(row) for row in session.query(*model.__table__.columns) if getattr(row, count))
+        return tables
+
+    business_ids = [random_id() for _ in range(3)]
+    records = make_records('reviews', 40, business_ids, [random_id()])
+    records[0]['stars'] = None
+    records[1]['date'] = None
+    post(records[:30])
+    post(records[25:])  # Re-post of 5 reviews
+    post(records[:10])  # Re-post of a whole batch
+    changed = make_records('reviews', 10, business_ids, [random_id()], ids=[r['review_id'] for r in records[10:20]])
+    post(changed)  # New business, stars, date and tokens
+    post([{'review_id': records[20]['review_id'], 'stars': 1.0},  # Partial updates
+          {'review_id': records[21]['review_id'], 'business_id': business_ids[0]}])
+    post([dict(records[22], stars=2.0), dict(records[22], stars=4.0)])  # One review twice in a batch
+
+    with app.app_context():
+        incremental = snapshot()
+        aggregates.rebuild(db.get_db())
+        assert snapshot() == incremental
+
+
+###Guardrails###
+def test_pages_within_row_limit_skip_the_estimate(app, monkeypatch):
+    import query
+
+    def estimate(session, params):
+        raise AssertionError('estimated a page under the row limit')
+    monkeypatch.setitem(query.ROW_ESTIMATORS, 'biz_words', estimate)
+    params = {'business_id': random_id(), 'limit': 100, 'after_date': '2019-01-01T00:00:00', 'after_review_id': 'x'}
+    response = app.test_client().get('/api/data', json={'schema': 'biz_words', 'params': params})
+    assert response.status_code == 200
+
+
+def test_streamed_and_columnar_gets_have_a_statement_timeout():
+    from errors import InvalidUsage
+    app = make_app(CACHE_SCHEMA_TIMEOUTS={}, STREAM_TIMEOUT_MS=1)
+    client = app.test_client()
+    business_id = random_id()
+    for _ in range(5):
+        records = make_records('reviews', 2000, [business_id], [random_id()])
+        assert client.post('/api/data', json={'table_name': 'reviews', 'data': records}).status_code == 200
+    for extra in ({'stream': True}, {'format': 'arrow'}):
+        params = dict({'business_id': business_id}, **extra)
+        # Cancelled after the response started: the body is cut off
+        with pytest.raises(InvalidUsage) as error:
+            client.get('/api/data', json={'schema': 'biz_words', 'params': params}).get_data()
+        assert error.value.status_code == 504
+
+
+def test_token_lists_are_stored_as_array_literals(app):
+    import db
+    from models import Review
+    business_id = random_id()
+    records = make_records('reviews', 1, [business_id], [random_id()])
+    records[0]['token'] = ['tacos', 'carne asada', 'say "hi" there']
+    client = app.test_client()
+    assert client.post('/api/data', json={'table_name': 'reviews', 'data': records}).status_code == 200
+    with app.app_context(), db.get_session() as session:
+        assert session.query(Review.token).scalar() == '{tacos,"carne asada","say \\"hi\\" there"}'
+    response = client.get('/api/data', json={'schema': 'top_tokens', 'params': {'business_id': business_id}})
+    assert {row['token'] for row in response.get_json()['data']} == {'tacos', 'carne asada', 'say "hi" there'}
+
+
+###Compression###
+def test_compressed_bodies_are_checked():
+    import gzip
+    import json
+    app = make_app(CACHE_SCHEMA_TIMEOUTS={}, MAX_DECOMPRESSED_BYTES=20000)
+    client = app.test_client()
+
+    def post(body, encoding='gzip'):
+        return client.post('/api/data', data=body, content_type='application/json',
+                           headers={'Content-Encoding': encoding}).status_code
+
+    def package(copies):
+        records = make_records('reviews', 5, [random_id()], [random_id()])
+        return gzip.compress(json.dumps({'table_name': 'reviews', 'data': records * copies}).encode())
+    assert post(package(1)) == 200
+    inflated = package(100)
+    assert len(inflated) < 20000 < len(gzip.decompress(inflated))
+    assert post(inflated) == 413
+    assert post(package(1), encoding='br') == 415
+    assert post(package(1)[:-20]) == 400
+
+
+###Cache###
+def test_posts_invalidate_cached_responses():
+    app = make_app()  # Default cache timeouts
+    client = app.test_client()
+    a, b = random_id(), random_id()
+    user_ids = [random_id()]
+
+    def post(table_name, records):
+        response = client.post('/api/data', json={'table_name': table_name, 'data': records})
+        assert response.status_code == 200 and response.get_json()['rejected'] == 0
+
+    def get(schema, business_id):
+        response = client.get('/api/data', json={'schema': schema, 'params': {'business_id': business_id}})
+        assert response.status_code == 200
+        return response.get_json()
+
+    businesses = make_records('businesses', 2, [a], user_ids, ids=[a, b])
+    post('businesses', businesses)
+    post('viz2', make_records('viz2', 1, [a], user_ids, ids=[a]))
+    reviews = make_records('reviews', 3, [a], user_ids) + make_records('reviews', 2, [b], user_ids)
+    post('reviews', reviews)
+    get('biz_comp', a)
+    post('businesses', [dict(businesses[0], city='Tempe')])
+    assert get('biz_comp', a)['city'] == 'Tempe'
+    post('viz2', [{'business_id': a, 'percentile': 0.25}])
+    assert get('biz_comp', a)['percentile'] == 0.25
+
+    assert len(get('biz_words', a)['data']) == 3
+    assert get('biz_stats', a)['review_count'] == 3
+    assert get('biz_stats', b)['review_count'] == 2
+    # Moved to b: the record names b only, a is invalidated from the aggregate update
+    post('reviews', [{'review_id': reviews[0]['review_id'], 'business_id': b}])
+    assert len(get('biz_words', a)['data']) == 2
+    assert get('biz_stats', a)['review_count'] == 2
+    assert get('biz_stats', b)['review_count'] == 3
+
+
+###ASGI###
+def asgi_request(asgi_app, body, headers=()):
+    import asyncio
+    import json
+    messages = []
+    scope = {'type': 'http', 'method': 'GET', 'path': '/api/data', 'query_string': b'',
+             'headers': [(b'content-type', b'application/json')] + list(headers)}
+
+    async def receive():
+        return {'type': 'http.request', 'body': json.dumps(body).encode() if body is not None else b''}
+
+    async def send(message):
+        messages.append(message)
+    asyncio.run(asgi_app(scope, receive, send))
+    return messages[0]['status'], dict(messages[0]['headers']), messages[1]['body']
+
+
+def test_asgi_gets_keep_the_flask_contract(app):
+    from asgi import create_asgi_app
+    asgi_app = create_asgi_app(app)
+    params = {'business_id': random_id()}
+    status, headers, _ = asgi_request(asgi_app, {'schema': 'biz_words', 'params': params},
+                                      [(b'origin', b'https://dashboard.example')])
+    assert status == 200
+    assert headers[b'access-control-allow-origin'] == b'https://dashboard.example'
+    assert asgi_request(asgi_app, None)[0] == app.test_client().get('/api/data').status_code == 400
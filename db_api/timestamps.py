@@ -0,0 +1,106 @@
+"""
+Timestamps
+    Batch coercion of the datetime columns in POST packages.  Records arrive from
+    DataFrame.to_json as epoch milliseconds or as ISO 8601 strings.  The format is detected
+    once per column per batch and the whole column is converted in one pass: numpy for
+    epoch milliseconds, datetime.fromisoformat for strings.  Mixed columns fall back to
+    converting value by value.
+
+    Results match the old per-record convert_to_datetime: epoch values become naive local
+    time, unparseable strings become 1969-01-01.
+"""
+import logging
+import time
+from datetime import datetime
+from numbers import Number
+
+import numpy as np
+
+
+timestamp_logger = logging.getLogger(__name__)
+
+DATETIME_FIELDS = ('date', 'yelping_since')
+DEFAULT_DATETIME = datetime(1969, 1, 1)  # Stored for unparseable date strings
+# Epoch milliseconds that convert to a datetime in every time zone (days inside datetime.min..max).
+# Callers reject values outside before coercing: numpy and datetime.fromtimestamp fail differently.
+EPOCH = datetime(1970, 1, 1)
+MIN_EPOCH_MS = (datetime(1, 1, 3) - EPOCH).total_seconds() * 1e3
+MAX_EPOCH_MS = (datetime(9999, 12, 30) - EPOCH).total_seconds() * 1e3
+
+
+def detect_format(values):
+    """'epoch_ms', 'iso', 'datetime' or 'mixed' for a column of non-null values."""
+    types = set(map(type, values))
+    if all(issubclass(t, Number) and t is not bool for t in types):
+        return 'epoch_ms'
+    if types == {str}:
+        return 'iso'
+    if types == {datetime}:
+        return 'datetime'  # Already converted (validated records)
+    return 'mixed'
+
+
+def local_is_utc():
+    # numpy converts epochs in UTC.  datetime.fromtimestamp uses local time.
+    return time.timezone == 0 and not time.daylight
+
+
+def from_epoch_ms(values):
+    if local_is_utc():
+        micros = np.rint(np.asarray(values, dtype='float64') * 1e3).astype('int64')
+        return micros.astype('datetime64[us]').tolist()
+    return [datetime.fromtimestamp(value / 1e3) for value in values]
+
+
+def from_iso(values):
+    try:
+        return list(map(datetime.fromisoformat, values))
+    except ValueError:
+        # At least one bad string.  Only those get the default.
+        return [parse_iso(value) for value in values]
+
+
+def parse_iso(value):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return DEFAULT_DATETIME
+
+
+def coerce_value(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, str):
+        return parse_iso(value)
+    return datetime.fromtimestamp(value / 1e3)
+
+
+def coerce_column(values):
+    """Convert a list of raw values to datetimes.  None and datetimes pass through."""
+    if None in values:
+        present = [i for i, value in enumerate(values) if value is not None]
+        column = [None] * len(values)
+        for i, value in zip(present, coerce_column([values[i] for i in present])):
+            column[i] = value
+        return column
+    fmt = detect_format(values)
+    if fmt == 'datetime':
+        return values
+    if fmt == 'epoch_ms':
+        return from_epoch_ms(values)
+    if fmt == 'iso':
+        return from_iso(values)
+    return [coerce_value(value) for value in values]
+
+
+def coerce_datetime_columns(records, fields=DATETIME_FIELDS):
+    """Convert the datetime fields of a batch of records in place."""
+    for field in fields:
+        rows = [record for record in records if field in record]
+        if not rows:
+            continue
+        column = coerce_column([record[field] for record in rows])
+        for record, value in zip(rows, column):
+            record[field] = value
+        timestamp_logger.debug('Coerced {} {} values'.format(len(rows), field))
+    return records
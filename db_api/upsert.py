@@ -0,0 +1,111 @@
+"""
+Bulk Upsert
+    Set-based INSERT/UPDATE for POST batches.
+    Existing keys are prefetched with one IN query per batch, new rows go out as a single
+    executemany and updates are applied in bulk.  On PostgreSQL, tables keyed on their
+    primary key use INSERT ... ON CONFLICT DO UPDATE instead.
+"""
+import logging
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+
+upsert_logger = logging.getLogger(__name__)
+
+# Maximum number of values bound into a single IN (...) clause.
+#   SQLite builds before 3.32 refuse more than 999 bound parameters per statement.
+IN_CHUNK_SIZE = 500
+
+
+def chunks(sequence, size=IN_CHUNK_SIZE):
+    """Yield successive slices of sequence of at most size elements"""
+    sequence = list(sequence)
+    for i in range(0, len(sequence), size):
+        yield sequence[i:i + size]
+
+
+def primary_key_name(model):
+    return model.__mapper__.primary_key[0].name
+
+
+def merge_by_key(records, key):
+    """Collapse records sharing a key into one mapping.  Later records win field by field,
+    matching the result of applying them one after another.
+    """
+    merged = {}
+    for record in records:
+        merged.setdefault(record[key], {}).update(record)
+    return merged
+
+
+def fetch_existing(session, model, key, values):
+    """Return {key value: [primary key values]} for rows already stored.
+
+    Non primary key lookups (review_sentiment, tip_sentiment, viz2) may match
+    more than one row.  All matches are returned so every one gets updated.
+    """
+    key_column = getattr(model, key)
+    pk_column = model.__mapper__.primary_key[0]
+    existing = {}
+    for chunk in chunks(values):
+        rows = session.query(key_column, pk_column).filter(key_column.in_(chunk))
+        for key_value, pk_value in rows:
+            existing.setdefault(key_value, []).append(pk_value)
+    return existing
+
+
+def upsert_records(session, model, records, key=None):
+    """Insert or update a batch of records for model inside session.  Does not commit.
+
+    param model: Mapped class from models.py
+    param records: Column name to value mappings
+    type records: list of dict
+    param key: Column identifying an existing row.  Defaults to the primary key.
+    type key: string
+    """
+    if not records:
+        return
+    pk_name = primary_key_name(model)
+    key = key or pk_name
+    merged = merge_by_key(records, key)
+
+    if key == pk_name and session.bind.dialect.name == 'postgresql':
+        upsert_on_conflict(session, model, key, merged.values())
+        return
+
+    existing = fetch_existing(session, model, key, merged.keys())
+    inserts = [record for key_value, record in merged.items() if key_value not in existing]
+    updates = []
+    for key_value, pk_values in existing.items():
+        for pk_value in pk_values:
+            update = dict(merged[key_value])
+            update[pk_name] = pk_value
+            updates.append(update)
+
+    upsert_logger.info('{}: {} inserts, {} updates'.format(
+        model.__tablename__, len(inserts), len(updates)))
+    if inserts:
+        session.bulk_insert_mappings(model, inserts)
+    if updates:
+        session.bulk_update_mappings(model, updates)
+
+
+def upsert_on_conflict(session, model, key, records):
+    """Dialect-native upsert (PostgreSQL).  Records are grouped by column set so each
+    group is sent as one executemany.
+    """
+    table = model.__table__
+    groups = {}
+    for record in records:
+        groups.setdefault(tuple(sorted(record.keys())), []).append(record)
+
+    for columns, rows in groups.items():
+        stmt = pg_insert(table)
+        update_columns = {c: stmt.excluded[c] for c in columns if c != key}
+        if update_columns:
+            stmt = stmt.on_conflict_do_update(index_elements=[key], set_=update_columns)
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=[key])
+        session.execute(stmt, rows)
+    upsert_logger.info('{}: {} rows upserted with ON CONFLICT'.format(
+        model.__tablename__, sum(len(rows) for rows in groups.values())))
@@ -0,0 +1,200 @@
+"""
+Validators
+    Per-table record checks compiled once from the column definitions in models.py.  A
+    POST batch is checked and coerced before it is queued for the writer: records with
+    unknown columns or values that cannot be stored in their column are rejected with
+    per-record errors, and the rest of the batch is written in one pass.
+
+    Coercions follow what the Yelp DataFrames send through DataFrame.to_json:
+        Integer  - ints, bools and whole floats
+        Float    - ints and floats
+        String   - strings.  Numbers are stored as text and dicts as their Python repr.
+                   Lists (token columns) become PostgreSQL array literals, '{a,b}': psycopg2
+                   bound lists as arrays, so that is the format stored rows already hold.
+        DateTime - epoch milliseconds or ISO 8601 strings (see timestamps.py)
+        JSON     - anything.  Viz2 aggregate fields are parsed to their stored shapes (viz2.py).
+    None is accepted for every column except the one a table is upserted on (KEY_COLUMNS),
+    which every record must carry.
+"""
+from datetime import datetime
+from numbers import Number
+
+from sqlalchemy import types
+
+from models import Base
+from timestamps import coerce_column, MIN_EPOCH_MS, MAX_EPOCH_MS
+import viz2
+
+
+MAX_REPORTED_ERRORS = 100  # Rejected records listed in a response.  The count is always exact.
+# Column each POST table is upserted on (the key= of its maker in query.py)
+KEY_COLUMNS = {
+    'businesses': 'business_id',
+    'users': 'user_id',
+    'checkins': 'checkin_id',
+    'photos': 'photo_id',
+    'tips': 'tip_id',
+    'reviews': 'review_id',
+    'review_sentiment': 'review_id',
+    'tip_sentiment': 'tip_id',
+    'viz2': 'business_id',
+}
+# Table-level parsing run on records that passed the column checks.  Raise ValueError({field: message}).
+NORMALIZERS = {
+    'viz2': viz2.normalize_record,
+}
+
+
+class Rejected(Exception):
+    pass
+
+
+def to_integer(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    raise Rejected('expected an integer, got {!r}'.format(value))
+
+
+def to_float(value):
+    if isinstance(value, Number) and not isinstance(value, bool):
+        return float(value)
+    raise Rejected('expected a number, got {!r}'.format(value))
+
+
+ARRAY_SPECIAL = set('{},"\\ \t\n')
+
+
+def array_element(value):
+    # Quoted and escaped like PostgreSQL's text[] output
+    if value is None:
+        return 'NULL'
+    if isinstance(value, list):
+        return array_literal(value)
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    text = str(value)
+    if not text or text.upper() == 'NULL' or not ARRAY_SPECIAL.isdisjoint(text):
+        return '"{}"'.format(text.replace('\\', '\\\\').replace('"', '\\"'))
+    return text
+
+
+def array_literal(values):
+    return '{' + ','.join(array_element(value) for value in values) + '}'
+
+
+def to_string(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list):
+        return array_literal(value)
+    if isinstance(value, (Number, dict)):
+        return str(value)
+    raise Rejected('expected a string, got {}'.format(type(value).__name__))
+
+
+def to_datetime_input(value):
+    # Converted column-wise afterwards by timestamps.coerce_column
+    if isinstance(value, (str, datetime)):
+        return value
+    if isinstance(value, Number) and not isinstance(value, bool):
+        if not MIN_EPOCH_MS <= value <= MAX_EPOCH_MS:  # Also false for NaN
+            raise Rejected('epoch milliseconds out of range, got {!r}'.format(value))
+        return value
+    raise Rejected('expected epoch milliseconds or an ISO 8601 string, got {!r}'.format(value))
+
+
+def to_json(value):
+    return value
+
+
+def converter(column_type):
+    if isinstance(column_type, types.Integer):
+        return to_integer
+    if isinstance(column_type, types.Float):
+        return to_float
+    if isinstance(column_type, types.DateTime):
+        return to_datetime_input
+    if isinstance(column_type, types.JSON):
+        return to_json
+    if isinstance(column_type, types.String):  # Includes Text
+        return to_string
+    return to_json
+
+
+class TableValidator():
+    """Checks records for one table.
+
+    param table: SQLAlchemy Table from models.py
+    """
+    def __init__(self, table):
+        self.table_name = table.name
+        self.key = KEY_COLUMNS.get(table.name)
+        self.normalize = NORMALIZERS.get(table.name)
+        self.converters = {column.name: converter(column.type) for column in table.columns}
+        self.datetime_columns = [column.name for column in table.columns
+                                 if isinstance(column.type, types.DateTime)]
+
+    def check_record(self, record):
+        """Coerced copy of record, or raise Rejected listing every bad field."""
+        errors = {}
+        checked = {}
+        if self.key is not None and record.get(self.key) is None:
+            errors[self.key] = 'required: {} records are matched on it'.format(self.table_name)
+        for key, value in record.items():
+            convert = self.converters.get(key)
+            if convert is None:
+                errors[key] = 'unknown column for {}'.format(self.table_name)
+                continue
+            if value is None:
+                checked[key] = None
+                continue
+            try:
+                checked[key] = convert(value)
+            except Rejected as e:
+                errors[key] = str(e)
+        if errors:
+            raise Rejected(errors)
+        if self.normalize is not None:
+            try:
+                self.normalize(checked)
+            except ValueError as e:
+                raise Rejected(e.args[0])
+        return checked
+
+    def validate(self, records):
+        """Split records into (valid, rejected).
+        valid: coerced copies with datetime columns converted.
+        rejected: [{'index': position in records, 'errors': {field: message}}]
+        """
+        valid = []
+        rejected = []
+        for index, record in enumerate(records):
+            try:
+                valid.append(self.check_record(record))
+            except Rejected as e:
+                rejected.append({'index': index, 'errors': e.args[0]})
+        for field in self.datetime_columns:
+            rows = [record for record in valid if field in record]
+            for record, value in zip(rows, coerce_column([record[field] for record in rows])):
+                record[field] = value
+        return valid, rejected
+
+
+VALIDATORS = {table.name: TableValidator(table) for table in Base.metadata.sorted_tables}
+
+
+def validate_records(table_name, records):
+    """(valid, rejected) for a batch of records posted to table_name."""
+    return VALIDATORS[table_name].validate(records)
+
+
+def rejection_report(rejected, offset=0):
+    """Response fragment for rejected records.  offset shifts indexes for sub-batches."""
+    return {
+        'rejected': len(rejected),
+        'errors': [dict(item, index=item['index'] + offset) for item in rejected[:MAX_REPORTED_ERRORS]],
+    }
@@ -0,0 +1,158 @@
+"""
+Viz2 Fields
+    Viz2 aggregates arrive from the notebooks as Python reprs (str(dict), str(tuple of lists),
+    JSON-quoted list strings).  They are parsed once, when a POST is validated, and stored
+    as JSON so biz_comp can return them without any parsing.  A field that cannot be parsed
+    rejects its record.
+
+    Stored shapes:
+        competitors, bestinsector:  [business_id, ...]
+        avg_stars_over_time:        {'avg_stars': [float, ...], 'dates': [str, ...]}
+        chunk_sentiment:            {'noun_chunks': [str, ...], 'chunk_sentiment': [float, ...]}
+        count_by_star:              {stars: count}
+        review_by_year:             {year: count}
+"""
+import ast
+import logging
+import re
+
+import ujson
+from sqlalchemy import bindparam, inspect, text
+
+from models import Viz2
+
+
+viz2_logger = logging.getLogger(__name__)
+
+PARSE_ERRORS = (ValueError, SyntaxError, KeyError, TypeError, AttributeError)
+
+
+class Unparsable(ValueError):
+    # args[0]: {field: message}
+    pass
+
+
+def decode(value):
+    # Undo JSON encoding (possibly repeated).  Returns native structures or the innermost string.
+    while isinstance(value, str):
+        try:
+            decoded = ujson.loads(value)
+        except ValueError:
+            return value
+        if decoded == value:
+            return value
+        value = decoded
+    return value
+
+
+def get_components(element):
+    return re.findall(r'\[([^]]+)\]', element)
+
+
+def strip_artifacts(element):
+    return element.strip().strip("'").strip('"')
+
+
+def parse_id_list(value):
+    value = decode(value)
+    if isinstance(value, (list, tuple)):
+        return [str(x) for x in value]
+    return [strip_artifacts(x) for x in value.strip('[]').split(',') if strip_artifacts(x)]
+
+
+def parse_pair(value, names, casts):
+    """Two parallel lists, from a mapping, a pair of lists or a legacy repr string."""
+    value = decode(value)
+    if isinstance(value, dict):
+        pair = [value[name] for name in names]
+    elif isinstance(value, (list, tuple)):
+        pair = list(value)
+    else:
+        pair = [x.split(',') for x in get_components(value)[:2]]
+    return {name: [cast(strip_artifacts(x) if isinstance(x, str) else x) for x in values]
+            for name, cast, values in zip(names, casts, pair)}
+
+
+def parse_counts(value):
+    value = decode(value)
+    if isinstance(value, str):
+        value = ast.literal_eval(value.strip('"'))
+    return {str(key): count for key, count in dict(value).items()}
+
+
+def parse_avg_stars(value):
+    # Legacy order: [avg_stars], [dates]
+    return parse_pair(value, names=('avg_stars', 'dates'), casts=(float, str))
+
+
+def parse_chunk_sentiment(value):
+    # Legacy order: [noun_chunks], [chunk_sentiment]
+    return parse_pair(value, names=('noun_chunks', 'chunk_sentiment'), casts=(str, float))
+
+
+PARSERS = {
+    'competitors': parse_id_list,
+    'bestinsector': parse_id_list,
+    'avg_stars_over_time': parse_avg_stars,
+    'chunk_sentiment': parse_chunk_sentiment,
+    'count_by_star': parse_counts,
+    'review_by_year': parse_counts,
+}
+
+
+def normalize_record(record):
+    """Parse Viz2 aggregate fields of a POST record into their stored JSON shapes (in place).
+    Raises Unparsable listing the fields that could not be parsed.
+    """
+    errors = {}
+    for field, parser in PARSERS.items():
+        if record.get(field) is not None:
+            try:
+                record[field] = parser(record[field])
+            except PARSE_ERRORS as e:
+                errors[field] = 'could not be parsed ({}: {})'.format(type(e).__name__, e)
+    if errors:
+        raise Unparsable(errors)
+    for key in record.keys():
+        # Remaining nested dictionaries are stored as strings (legacy behaviour)
+        if type(record[key]) == dict and key not in PARSERS:
+            record[key] = str(record[key])
+    return record
+
+
+def migrate(engine):
+    """One-shot migration of existing Viz2 rows from legacy strings to JSON.  Safe to re-run.
+    On PostgreSQL the columns are then converted to the json type.
+    Returns the number of rows rewritten.
+    """
+    fields = list(PARSERS.keys())
+    table = Viz2.__table__
+    with engine.begin() as connection:
+        rows = connection.execute(text('SELECT vz_id, {} FROM viz2'.format(', '.join(fields)))).fetchall()
+        updates = []
+        for row in rows:
+            update = {'_vz_id': row['vz_id']}
+            for field in fields:
+                if row[field] is None:
+                    update[field] = None
+                    continue
+                try:
+                    update[field] = PARSERS[field](row[field])
+                except PARSE_ERRORS:
+                    viz2_logger.warning('viz2 {} {} could not be parsed.  Cleared.'.format(row['vz_id'], field))
+                    update[field] = None
+            updates.append(update)
+        if updates:
+            connection.execute(
+                table.update().where(table.c.vz_id == bindparam('_vz_id')).values(
+                    {field: bindparam(field) for field in fields}),
+                updates)
+
+        if engine.dialect.name == 'postgresql':
+            column_types = {c['name']: str(c['type']).lower() for c in inspect(connection).get_columns('viz2')}
+            for field in fields:
+                if column_types.get(field) not in ('json', 'jsonb'):
+                    connection.execute(text(
+                        'ALTER TABLE viz2 ALTER COLUMN {0} TYPE JSON USING {0}::json'.format(field)))
+    viz2_logger.info('Migrated {} viz2 rows to JSON'.format(len(updates)))
+    return len(updates)
@@ -0,0 +1,180 @@
+"""
+Write Coordinator
+    Group commit for POST batches.  Request handlers enqueue their records and wait; one writer
+    thread per table drains everything queued so far and commits it in a single transaction.
+    Each request is acknowledged only after the transaction holding its records has committed.
+
+    Batches may carry a fingerprint (see fingerprints.py).  Fingerprinted batches already
+    committed, or repeated within the same group, are acknowledged as duplicates without
+    being written again.
+"""
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+from flask import current_app
+
+import metrics
+
+
+writer_logger = logging.getLogger(__name__)
+
+
+class WriteCoordinator():
+    """Per-table writer threads with group commit.
+
+    param app: Flask app.  Writer threads run inside its app context.
+    param apply: Callable(table_name, records, fingerprints) that writes and commits records
+        and the [(fingerprint, record count)] of the fingerprinted batches among them.
+    param applied: Callable(fingerprints) -> {fingerprint: record count} of the batches
+        already committed.  None disables duplicate detection.
+    param max_records: Upper bound on records coalesced into one commit.
+    """
+    def __init__(self, app, apply, applied=None, max_records=1000):
+        self.app = app
+        self.apply = apply
+        self.applied = applied
+        self.max_records = max_records
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queues = {}
+        self.stats = {}
+
+    def submit(self, table_name, records, fingerprint=None):
+        """Queue records for table_name.  Returns a Future resolved once they are committed,
+        with {'applied': record count, 'duplicate': bool}.
+        """
+        future = Future()
+        self.get_queue(table_name).put((records, future, fingerprint))
+        return future
+
+    def get_queue(self, table_name):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Threads do not survive fork.  Start fresh in each worker process.
+                self.queues, self.stats, self.pid = {}, {}, os.getpid()
+            if table_name not in self.queues:
+                self.queues[table_name] = queue.Queue()
+                self.stats[table_name] = {'commits': 0, 'batches': 0, 'records': 0,
+                                          'failures': 0, 'duplicates': 0,
+                                          'last_commit_size': 0, 'max_commit_size': 0}
+                thread = threading.Thread(target=self.run, args=(table_name,),
+                                          name='writer-' + table_name, daemon=True)
+                thread.start()
+        return self.queues[table_name]
+
+    def run(self, table_name):
+        jobs = self.queues[table_name]
+        with self.app.app_context():
+            while True:
+                # Block for the first batch, then take whatever else is already waiting
+                group = [jobs.get()]
+                size = len(group[0][0])
+                while size < self.max_records:
+                    try:
+                        item = jobs.get_nowait()
+                    except queue.Empty:
+                        break
+                    group.append(item)
+                    size += len(item[0])
+                try:
+                    self.commit(table_name, group)
+                except Exception as e:
+                    # A dead writer would leave every later batch for the table waiting out WRITE_TIMEOUT
+                    writer_logger.exception('Writer for {} failed on a group of {} batches'.format(table_name, len(group)))
+                    for _, future, _ in group:
+                        if not future.done():
+                            future.set_exception(e)
+
+    def commit(self, table_name, group):
+        repeats = []
+        collector = metrics.begin()
+        try:
+            # The duplicate lookup reads the database too.  Its errors fail the group like the write's.
+            group, repeats = self.skip_duplicates(table_name, group)
+            if not group:
+                metrics.end()
+                return
+            # Copies keep the original records intact for the per-batch retry below
+            records = [dict(record) for batch, _, _ in group for record in batch]
+            fingerprints = [(fingerprint, len(batch)) for batch, _, fingerprint in group if fingerprint]
+            self.apply(table_name, records, fingerprints)
+        except Exception as e:
+            metrics.end()
+            if len(group) == 1:
+                writer_logger.error('{} batch of {} failed: {}'.format(table_name, len(group[0][0]), e))
+                with self.lock:
+                    self.stats[table_name]['failures'] += 1
+                for _, future, _ in group + repeats:
+                    future.set_exception(e)
+                return
+            # One bad batch must not fail the others.  Commit each batch separately.
+            writer_logger.info('Group commit of {} batches failed.  Retrying individually.'.format(len(group)))
+            for item in group + repeats:
+                self.commit(table_name, [item])
+            return
+        metrics.end()
+        # Committed: acknowledge before the bookkeeping below
+        for batch, future, _ in group:
+            future.set_result({'applied': len(batch), 'duplicate': False})
+        for batch, future, _ in repeats:
+            future.set_result({'applied': len(batch), 'duplicate': True})
+
+        metrics.record_write(table_name, collector, len(records))
+        writer_logger.info('Group commit: {} records from {} batches into {}'.format(
+            len(records), len(group), table_name))
+        with self.lock:
+            stats = self.stats[table_name]
+            stats['commits'] += 1
+            stats['batches'] += len(group)
+            stats['records'] += len(records)
+            stats['last_commit_size'] = len(records)
+            stats['max_commit_size'] = max(stats['max_commit_size'], len(records))
+
+    def skip_duplicates(self, table_name, group):
+        """Acknowledge batches whose fingerprint is already committed.  Returns the batches to
+        write and the repeats of a fingerprint earlier in the group (settled with it).
+        """
+        fingerprints = [fingerprint for _, _, fingerprint in group if fingerprint]
+        if not fingerprints or self.applied is None:
+            return group, []
+        applied = self.applied(fingerprints)
+        unique, repeats, seen = [], [], set()
+        for item in group:
+            batch, future, fingerprint = item
+            if fingerprint in applied:
+                future.set_result({'applied': applied[fingerprint], 'duplicate': True})
+            elif fingerprint in seen:
+                repeats.append(item)
+            else:
+                if fingerprint:
+                    seen.add(fingerprint)
+                unique.append(item)
+        skipped = len(group) - len(unique)
+        if skipped:
+            writer_logger.info('Skipped {} duplicate batches for {}'.format(skipped, table_name))
+            with self.lock:
+                self.stats[table_name]['duplicates'] += skipped
+        return unique, repeats
+
+    def status(self):
+        """Queue depth and commit sizes per table for this worker process."""
+        with self.lock:
+            status = {}
+            for table_name, jobs in self.queues.items():
+                stats = dict(self.stats[table_name])
+                stats['queue_depth'] = jobs.qsize()
+                stats['mean_commit_size'] = stats['records'] / stats['commits'] if stats['commits'] else 0.0
+                status[table_name] = stats
+        return status
+
+
+def get_coordinator():
+    return current_app.extensions['write_coordinator']
+
+
+def init_app(app, apply, applied=None):
+    app.extensions['write_coordinator'] = WriteCoordinator(
+        app, apply=apply, applied=applied, max_records=app.config['WRITE_GROUP_MAX_RECORDS'])
@@ -3,6 +3,7 @@ import requests
 from flask_cors import CORS, cross_origin
 from .timeseries import timeseries
 from .dashboard import jsondata
+from .serializer import json_response
 
 
 def create_app():
@@ -16,7 +17,7 @@ def create_app():
         data = request.get_json(force=True)
         predict_request = data['business_id']
         result = timeseries(predict_request)
-        return result
+        return json_response(result)
 
     @app.route('/dashboard', methods=['POST'])
     def get_data():
@@ -1,6 +1,6 @@
 import ast
 import pandas as pd
-from flask import jsonify
+from .serializer import json_response
 
 
 def create_dict(list1, list2, key1, key2):
@@ -49,6 +49,6 @@ def jsondata(bus_id):
     df = df[df['business_id'] == bus_id]
     df = df.to_dict('records')
     cleaned = clean_data(df)
-    data = jsonify(cleaned)
+    data = json_response(cleaned)
 
     return data
\ No newline at end of file
@@ -0,0 +1,82 @@
+"""
+Serializer
+    Fast JSON encoding for API responses.  Uses orjson when installed and falls back to the
+    standard library.  Numpy scalars/arrays and SQLAlchemy result rows are encoded natively,
+    without a pass through Flask's JSONEncoder.  Dates and datetimes keep the RFC 1123 format
+    Flask's encoder wrote ("Tue, 01 Jan 2019 00:00:00 GMT"), which clients parse.
+
+    Copy of db_api/serializer.py (apps deploy separately).  Keep the copies in sync.
+"""
+import datetime
+import json
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+@lru_cache(maxsize=4096)
+def http_day(day):
+    # 'Tue, 01 Jan 2019 ', shared by every datetime on that day
+    return '{}, {:02d} {} {:04d} '.format(WEEKDAYS[day.weekday()], day.day, MONTHS[day.month - 1], day.year)
+
+
+def http_date(value):
+    """Same string as werkzeug.http.http_date(value.utctimetuple()), as Flask's JSONEncoder
+    wrote it.  Naive datetimes are taken as UTC.  About 3x faster: one call per row.
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc)
+    return http_day(value.date()) + '%02d:%02d:%02d GMT' % (value.hour, value.minute, value.second)
+
+
+def default(obj):
+    # Types the JSON backends do not encode on their own
+    if isinstance(obj, datetime.datetime):
+        return http_date(obj)
+    if isinstance(obj, datetime.date):
+        return http_day(obj) + '00:00:00 GMT'
+    if isinstance(obj, datetime.time):
+        return obj.isoformat()
+    if np is not None:
+        if isinstance(obj, np.generic):
+            return obj.item()
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+    if isinstance(obj, Sequence):
+        # SQLAlchemy result rows (KeyedTuple, RowProxy) and other tuple subclasses
+        return list(obj)
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+if orjson is not None:
+    # Datetimes go through default() instead of orjson's ISO 8601
+    OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(obj):
+        """Encode obj as JSON bytes"""
+        return orjson.dumps(obj, default=default, option=OPTIONS)
+else:
+    def dumps(obj):
+        """Encode obj as JSON bytes"""
+        return json.dumps(obj, default=default, separators=(',', ':')).encode()
+
+
+def json_response(obj, status=200):
+    return Response(dumps(obj), status=status, mimetype='application/json')
@@ -36,9 +36,9 @@ def timeseries(bus_id):
     df_final = pd.concat(counts)
     df_final['date'] = df_final['date'].astype(str)
     df_final = df_final.reset_index()
-    output = (df_final.groupby(['date'], as_index=True)
-             .apply(lambda x: x[['word','count','pct_total','rank',\
-                 'star_review']].to_dict('r'))
-              .to_json()).replace("'", "")
+    df_final['word'] = df_final['word'].str.replace("'", "")
+    # {date: [{word, count, pct_total, rank, star_review}, ...]}, encoded by serializer
+    output = {date: group[['word','count','pct_total','rank','star_review']].to_dict('records')
+              for date, group in df_final.groupby('date')}
 
     return output
\ No newline at end of file